@@ -0,0 +1,191 @@
+############################################################################
+#
+#   CodeRunner.py
+#       run code in zettel (after a #! line) in a separate worker process,
+#       with a time and memory limit, caching the output
+#
+############################################################################
+
+import io
+import os
+import re
+import sys
+import pickle
+import select
+import hashlib
+import subprocess
+from collections import OrderedDict
+from contextlib import redirect_stdout
+import config
+import utils
+
+# regex to match dependencies declared in code, e.g. '# depends: #230101a',
+#   or '# depends: kasten' for code that looks at the whole kasten
+depends_re = re.compile(r'^\s*#\s*depends:(.*)$', re.MULTILINE)
+
+# run in the worker process: take ID, code and changes to the kasten (see
+#   CodeRunner.note) from stdin, send back a flag for success and the output
+#   (or the error) on stdout
+def serve(memory_limit):
+    from KastenQuery import KastenQuery
+    # keep the channel to ourselves, pointing stdin/stdout/stderr (which
+    #   code may use) at /dev/null
+    requests = os.fdopen(os.dup(0), 'rb')
+    results = os.fdopen(os.dup(1), 'wb')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    try:
+        import resource
+        limit = memory_limit * 2**20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError):
+        pass    # no limit on this platform
+    # kept between runs, so its caches stay warm
+    kasten = KastenQuery()
+    while True:
+        try:
+            ID, code, changes = pickle.load(requests)
+        except EOFError:
+            return  # UI process went away
+        kasten.start(ID, changes)
+        # run in a fresh namespace, with queries on the kasten and the
+        #   modules code used to find lying around when it was run inside
+        #   the viewer
+        namespace = {'__name__': '__zettel__', 'kasten': kasten, 'os': os,
+                'sys': sys, 're': re, 'io': io, 'utils': utils,
+                'config': config}
+        try:
+            with io.StringIO() as out, redirect_stdout(out):
+                exec(code, namespace)
+                output = out.getvalue()
+            result = (True, output)
+        except BaseException as e:
+            result = (False, str(e) or type(e).__name__)
+        try:
+            pickle.dump(result, results)
+        except MemoryError:
+            pickle.dump((False, 'MemoryError'), results)
+        results.flush()
+
+class CodeRunner:
+    # how many outputs to keep
+    max_outputs = 256
+
+    def __init__(self, timeout=None, memory_limit=None):
+        # seconds code may run for, before the worker is killed
+        self.timeout = timeout or config.code_timeout
+        # megabytes of memory the worker may use
+        self.memory_limit = memory_limit or config.code_memory_limit
+        # worker process, started when there's code to run
+        self.process = None
+        # key (hash of code and dependencies) -> lines, least recently
+        #   used first
+        self.outputs = OrderedDict()
+        # zettel changed since the worker last heard, ID -> flag for deleted,
+        #   passed on with the next code to run, or None for changes the UI
+        #   lost track of (the worker rescans the kasten)
+        self.changes = {}
+
+    # start worker process, if there isn't one running
+    # a fresh interpreter running this file, so it doesn't inherit curses
+    #   or our threads, but can import what we can
+    def start(self):
+        if self.process is not None and self.process.poll() is None:
+            return
+        self.changes = {}   # new worker, nothing to catch up on
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        self.process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__),
+                    str(self.memory_limit)],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL, env=env)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process.stdin.close()
+            self.process.stdout.close()
+        self.process = None
+
+    # zettel ID changed (or was deleted), called as indexes are updated, or
+    #   with ID None for a rescan that may have picked up anything
+    def note(self, ID, deleted=False):
+        if ID is None:
+            self.changes = None
+        elif self.changes is not None:
+            self.changes[ID] = deleted
+
+    # what code says it depends on, in lines like
+    #   # depends: #230101a #230102b
+    # returns IDs of zettel, and a flag for depending on the whole kasten
+    def dependencies(self, code):
+        from LinkGraph import find_links
+        declared = '\n'.join(depends_re.findall(code))
+        return find_links(declared), 'kasten' in declared.split()
+
+    # output changes when code (or the zettel it's in) does, or anything it
+    #   depends on
+    def key(self, code, ID):
+        h = hashlib.sha256(repr((ID, code)).encode())
+        IDs, whole_kasten = self.dependencies(code)
+        for dep_ID in IDs:
+            try:
+                stat = utils.storage().stat(dep_ID)
+            except OSError:
+                stat = None
+            h.update(repr((dep_ID, stat)).encode())
+        if whole_kasten:
+            h.update(repr(utils.kasten_version()).encode())
+        return h.hexdigest()
+
+    # lines to show in place of code in zettel ID: its output, or else the
+    #   code with the error after it
+    # reruns code only if it (or its dependencies) changed since last time
+    def run(self, code, ID=None):
+        # the worker only reads the indexes kept here, so code querying the
+        #   kasten has them loaded (and brought up to date) once, before its
+        #   time starts, and before changes they pick up go into its key
+        if 'kasten' in code:
+            utils.link_graph()
+            utils.search_index()
+        key = self.key(code, ID)
+        lines = self.outputs.pop(key, None)
+        if lines is None:
+            ok, text = self.execute(code, ID)
+            if ok:
+                lines = text.splitlines()
+            else:
+                lines = code.split('\n') + text.splitlines()
+        self.outputs[key] = lines
+        while len(self.outputs) > self.max_outputs:
+            self.outputs.popitem(last=False)
+        return lines
+
+    # drop output of code, so it gets rerun
+    def forget(self, code, ID=None):
+        self.outputs.pop(self.key(code, ID), None)
+
+    # run code in worker, return flag for success and output (or error)
+    def execute(self, code, ID=None):
+        self.start()
+        # the worker reads indexes from disk, with any changes made here
+        utils.save_indexes(now=True)
+        try:
+            pickle.dump((ID, code, self.changes), self.process.stdin)
+            self.process.stdin.flush()
+            self.changes = {}
+            ready, _, _ = select.select([self.process.stdout], [], [],
+                    self.timeout)
+            if not ready:
+                self.stop()     # stuck, kill worker and start over
+                return False, f'timed out after {self.timeout} seconds'
+            return pickle.load(self.process.stdout)
+        except (EOFError, OSError, pickle.UnpicklingError):
+            # worker died, e.g. ran out of memory in a way we couldn't catch
+            self.stop()
+            return False, 'code worker died'
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]))
@@ -8,21 +8,78 @@
 import curses
 import time
 import sys
+import hashlib
 from Keys import Keys
 import config
 import utils
+from LineLayout import LineLayout
+from FileLines import FileLines
+from FileLayout import FileLayout
+from TextBuffer import TextBuffer
+from UndoLog import UndoLog
+from Journal import Journal, replay
+
+# hash of text as it would be saved, i.e. ending in a newline, to tell
+#   whether two texts are the same without keeping a copy of either
+# text can also be bytes of text encoded as UTF-8, see mapped_text
+def digest(text):
+    if isinstance(text, str):
+        text = text.encode('utf-8')
+    text_hash = hashlib.sha256(text)
+    if text[-1:] != b'\n':
+        text_hash.update(b'\n')
+    return text_hash.hexdigest()
+
+# text of big zettel lines (FileLines) to hash: the file as it is if that's
+#   the same as the text of the lines (the usual case), so it isn't decoded
+#   and put together, otherwise the lines
+def mapped_text(lines):
+    if lines.exact:
+        return lines.data
+    return '\n'.join(lines) + '\n'
 
 class Editor:
-    def __init__(self, win, filepath, row=0, col=0):
+    # row is the top line to show, or viewer_row the top row of a viewer on
+    #   the same zettel in the same window, to show the same part of it
+    def __init__(self, win, filepath, row=0, col=0, viewer_row=None):
         # curses window we're living in
         self.win = win
-        # load text from file as a list of lines (without trailing newlines)
+        # load text from file as lines (without trailing newlines)
         self.filepath = filepath
-        with open(self.filepath, 'r') as f:
-            self.lines = f.readlines() or [''] # in case of empty file
-        self.lines = [ line.rstrip('\n') for line in self.lines ]
+        self.ID = self.filepath.split('/')[-1] # extract ID from filepath
+        stat = utils.storage().stat(self.ID) # before reading, see save()
         # dimensions of window
         self.rows, self.cols = self.win.getmaxyx()
+        # rows each line takes up in window, kept up to date with each edit
+        #   by self.lines
+        self.large = stat[1] >= config.large_file_threshold \
+                and hasattr(utils.storage(), 'map')
+        if self.large:
+            # big zettel (pasted logs, exported data), map the file and only
+            #   decode and lay out lines as they're looked at
+            lines = FileLines(utils.storage().map(self.ID))
+            text = mapped_text(lines)
+            self.layout = FileLayout(lines, self.cols)
+        else:
+            text = utils.read_text(self.ID)
+            lines = utils.split_lines(text) or [''] # in case of empty file
+            self.layout = LineLayout((len(line) for line in lines), self.cols)
+        # edits made, to undo and redo
+        self.history = UndoLog()
+        # edits made since last save, kept in a file in case zk dies
+        self.journal = Journal(self.ID, digest(text))
+        # text being edited, all edits go through its insert/delete methods
+        self.lines = TextBuffer(lines, self.layout, self.history,
+                self.journal)
+        # zettel as last loaded or saved: generation of self.lines then, hash
+        #   of the text, and stat of the file, to tell whether there are
+        #   unsaved changes or the file changed behind our back, without
+        #   reading it again
+        self.saved_generation = self.lines.generation
+        self.saved_hash = self.journal.text_hash
+        self.saved_stat = stat
+        if viewer_row is not None:
+            row = utils.convert_row(self.layout, viewer_row=viewer_row)
 
         # top line of text visible
         self.top = row
@@ -72,42 +129,36 @@ class Editor:
     def end_search(self):
         self.searching = False
 
+    # find self.top for the cursor position, and mark window to be drawn
+    #   with the next frame (see WindowStack.render)
     def refresh(self):
-        self.win.erase()
+        self.scroll()
+        self.dirty = True
 
-        # first order of business: find self.top, top visible row
+    # find self.top, top visible row
+    def scroll(self):
+        layout = self.layout
         # automatically scroll up if there are empty lines at the bottom
-        #   and moving up a line would still fit
+        #   and moving up a line would still fit, i.e. up to the line after
+        #   the last one that leaves more than a window's worth of rows
+        #   below its start
         if self.top > 0:
-            buffer_rows = [
-                    max(1, -(len(line) // -self.cols) ) # ceiling division
-                    for line in self.lines[self.top-1:]
-                    ]
-            while sum(buffer_rows) <= self.rows:
-                self.top -= 1
-                if self.top == 0:
-                    break
-                buffer_rows.insert(0,
-                        max(1, -(len(self.lines[self.top-1]) // -self.cols))
-                        )
+            overflow = layout.total() - self.rows
+            if overflow > 0:
+                self.top = min(self.top, layout.find(overflow - 1)[0] + 1)
+            else:
+                self.top = 0
         if self.row > self.top:  # if too high, gotta worry about wraps
             # just worry about getting the whole current line on screen
             # NOTE: this won't work nice if current line overflows window
-            # compute list of how many rows in window each line takes
-            win_rows = [
-                    max(1, -(len(line) // -self.cols) ) # ceiling division
-                    for line in self.lines[self.top:self.row+1]
-                    ]
-            moves = 0
-            # move down until it fits
-            while sum(win_rows) > self.rows:
-                win_rows.pop(0)
-                moves += 1
-            self.top += moves
+            # move down to the first line that fits it all
+            bottom = layout.start(self.row + 1)
+            if bottom - layout.start(self.top) > self.rows:
+                self.top = layout.find(bottom - self.rows - 1)[0] + 1
             # check for edge case where cursor goes off the bottom
-            if sum(win_rows) == self.rows:
+            if bottom - layout.start(self.top) == self.rows:
                 # current line goes to last row in window
-                current_length = len(self.lines[self.row])
+                current_length = self.lines.length(self.row)
                 if current_length % self.cols == 0 and current_length > 0:
                     # current line goes to last character in window
                     # gotta move down one more line
@@ -115,6 +166,10 @@ class Editor:
         if self.row < self.top: # if top is too low, it's simple
             self.top = self.row # move up to active row
 
+    def render(self):
+        self.dirty = False
+        self.win.erase()
+
         # write lines and find cursor position
         # recall self.row, self.col is relative to self.lines, not window
         j = 0
@@ -156,40 +211,42 @@ class Editor:
             #   the window and error
             pass
 
-        self.win.refresh()
+        # to screen on the next curses.doupdate(), with everything else
+        self.win.noutrefresh()
 
     def flash(self):
         # only flash if text is working attribute is normal
         if self.attr != curses.A_NORMAL:
             return
         self.attr = curses.A_REVERSE
-        self.refresh()
+        self.render()
+        curses.doupdate()   # show it now, not with the next frame
         time.sleep(0.1)
         self.attr = curses.A_NORMAL
         self.refresh()
 
     # self.up/down/left/right just move relative to self.lines, cursor
-    #   position and self.top are computed in self.refresh()
+    #   position and self.top are computed in self.refresh()/self.render()
     def up(self):
         if self.row > 0:
             self.row -= 1
         # check if we're past the end of a line
-        if self.col > len(self.lines[self.row]):
-            self.col = len(self.lines[self.row])
+        if self.col > self.lines.length(self.row):
+            self.col = self.lines.length(self.row)
         # or if we can go back to(wards) hidden_col
         elif self.col < self.hidden_col:
-            self.col = min(self.hidden_col, len(self.lines[self.row]))
+            self.col = min(self.hidden_col, self.lines.length(self.row))
         self.refresh()
 
     def down(self):
         if self.row < len(self.lines)-1:
             self.row += 1
         # check if we're past the end of a line
-        if self.col > len(self.lines[self.row]):
-            self.col = len(self.lines[self.row])
+        if self.col > self.lines.length(self.row):
+            self.col = self.lines.length(self.row)
         # or if we can go back to(wards) hidden_col
         elif self.col < self.hidden_col:
-            self.col = min(self.hidden_col, len(self.lines[self.row]))
+            self.col = min(self.hidden_col, self.lines.length(self.row))
         self.refresh()
 
     def left(self):
@@ -199,7 +256,7 @@ class Editor:
         self.refresh()
 
     def right(self):
-        if self.col < len(self.lines[self.row]):
+        if self.col < self.lines.length(self.row):
             self.col += 1
         self.hidden_col = self.col  # reset hidden_col
         self.refresh()
@@ -219,7 +276,8 @@ class Editor:
         # jump forward a word (i.e. to the next space)
         col = self.lines[self.row].find(' ', self.col+1)
         if col == -1:
-            self.col = len(self.lines[self.row])-1
+            # (not before the start, on an empty line)
+            self.col = max(0, self.lines.length(self.row)-1)
             self.hidden_col = self.col
         else:
             self.col = col
@@ -232,25 +290,23 @@ class Editor:
         self.refresh()
 
     def line_end(self):
-        self.col = len(self.lines[self.row])
+        self.col = self.lines.length(self.row)
         self.hidden_col = self.col  # reset hidden_col
         self.refresh()
 
     def backspace(self):
         # if we're in the middle of a line
         if self.col > 0:
-            self.lines[self.row] = self.lines[self.row][:self.col-1] \
-                    + self.lines[self.row][self.col:]
+            self.lines.delete(self.row, self.col-1, self.row, self.col)
             self.col -= 1   # move cursor
             self.hidden_col = self.col
         # if we're at the beginning of a line (not the first)
         elif self.row > 0:
-            # pop the current line, move up a row and add it to that line
-            line = self.lines.pop(self.row)
+            # move up a row and join the current line onto that line
             self.row -= 1
-            self.col = len(self.lines[self.row]) # move cursor
+            self.col = self.lines.length(self.row) # move cursor
             self.hidden_col = self.col
-            self.lines[self.row] += line
+            self.lines.delete(self.row, self.col, self.row+1, 0)
         self.refresh()
 
     def tab(self):
@@ -259,26 +315,54 @@ class Editor:
             self.insert(Keys.SPACE)
 
     def newline(self):
-        # split line in half
-        first = self.lines[self.row][:self.col]
-        second = self.lines[self.row][self.col:]
-        # current line becomes first half
-        self.lines[self.row] = first
-        # move to next line and insert second half
-        self.row += 1
-        self.lines.insert(self.row, second)
-        # move to beginning of line
-        self.col = 0
+        # split line in half, and move to beginning of second half
+        self.row, self.col = self.lines.insert(self.row, self.col, '\n')
+        self.hidden_col = self.col
+        self.refresh()
+
+    # whether text differs from the zettel as last loaded or saved, only
+    #   hashing it if something was edited since (maybe undone again)
+    def modified(self):
+        if self.lines.generation == self.saved_generation:
+            return False
+        return digest(self.lines.text()) != self.saved_hash
+
+    # whether zettel was changed (or deleted) by something else since we
+    #   last loaded or saved it, only reading it if its stat changed
+    def changed_on_disk(self):
+        try:
+            stat = utils.storage().stat(self.ID)
+            if stat == self.saved_stat:
+                return False
+            if stat is None: # gone
+                return True
+            if self.large:  # read it the same way as when it was loaded
+                text = mapped_text(FileLines(utils.storage().map(self.ID)))
+            else:
+                text = utils.read_text(self.ID)
+            return digest(text) != self.saved_hash
+        except OSError:
+            return True
+
+    # make edits from journal at path, left behind by an editor that never
+    #   closed, leaving them unsaved (and in this editor's journal)
+    # returns False if they were made to some other version of the zettel
+    def recover(self, path):
+        edits = replay(path, self.saved_hash)
+        if edits is None:
+            return False
+        for edit in edits:  # leaving cursor after the last one
+            self.row, self.col = self.history.apply(self.lines, edit)
         self.hidden_col = self.col
+        self.history.close()
+        self.journal.flush()
         self.refresh()
+        return True
 
     def to_viewer(self):
-        # check for changes by loading (& stripping) file text again
-        with open(self.filepath, 'r') as f:
-            file_text = f.readlines()
-        file_text = [line.rstrip('\n') for line in file_text]
         # prompt if close without saving
-        if self.lines != file_text:
+        if self.modified():
+            self.render() # catch up with keys not drawn yet
             self.win.insstr(0,0," Close without saving? ",curses.A_REVERSE)
             self.win.refresh()
             k = self.win.getch()
@@ -287,17 +371,15 @@ class Editor:
                 flag, val = None, None
                 return flag, val
         # if no changes or confirmed above, proceed to viewer
+        self.journal.close()
         ID = self.filepath.split('/')[-1] # extract ID from filepath
         flag, val = 'edit->open', [ID, self.top]
         return flag, val
 
     def close(self):
-        # check for changes by loading (& stripping) file text again
-        with open(self.filepath, 'r') as f:
-            file_text = f.readlines()
-        file_text = [line.rstrip('\n') for line in file_text]
         # prompt if close without saving
-        if self.lines != file_text:
+        if self.modified():
+            self.render() # catch up with keys not drawn yet
             self.win.insstr(0,0," Close without saving? ",curses.A_REVERSE)
             self.win.refresh()
             k = self.win.getch()
@@ -306,24 +388,33 @@ class Editor:
                 flag, val = None, None
                 return flag, val
         # if no changes or confirmed above, proceed to close
+        self.journal.close()
         flag, val = 'close_window', None
         return flag, val
 
     def save(self):
+        # prompt before clobbering changes made by something else
+        if self.changed_on_disk():
+            self.render() # catch up with keys not drawn yet
+            self.win.insstr(0,0," Changed on disk, overwrite? ",curses.A_REVERSE)
+            self.win.refresh()
+            k = self.win.getch()
+            if k != Keys.CTRL_s: # anything but CTRL+s, don't save
+                self.refresh()
+                return
         try:
+            self.render() # catch up with keys not drawn yet
             self.win.addstr(0,0," saving ... ",curses.A_REVERSE)
             self.win.refresh()
         except curses.error:
             pass
-        with open(self.filepath, 'w') as f:
-            f.write('\n'.join(self.lines) + '\n')
-        if config.kasten_sync:
-            try:
-                self.win.addstr(0,0," syncing ... ",curses.A_REVERSE)
-                self.win.refresh()
-            except curses.error:
-                pass
-            utils.sync()
+        text = self.lines.text()
+        utils.write_zettel(self.ID, text)
+        self.saved_generation = self.lines.generation
+        self.saved_hash = digest(text)
+        self.saved_stat = utils.storage().stat(self.ID)
+        self.journal.restart(self.saved_hash)
+        utils.sync()    # in the background
         self.flash()    # flash window to confirm
         self.refresh()
 
@@ -331,14 +422,15 @@ class Editor:
         if len(self.clipboard) > 0:
             # insert last elt of clipboard as new line after current line
             line = self.clipboard.pop()
-            self.lines.insert(self.row + 1, line)
+            self.lines.insert_lines(self.row + 1, [line])
             # move down and up to work out cursor postiion
             self.down()
             self.up()
 
     def cut(self):
         # cut current line to clipboard
-        line = self.lines.pop(self.row)
+        # (leaving an empty line if it was the only one)
+        line, = self.lines.delete_lines(self.row, self.row+1)
         self.clipboard.append(line)
         # work out line and cursor position
         if self.row == len(self.lines):
@@ -351,26 +443,45 @@ class Editor:
             self.up()
 
     def insert(self, k):
-        self.lines[self.row] = self.lines[self.row][:self.col] \
-                + chr(k) \
-                + self.lines[self.row][self.col:]
+        self.lines.insert(self.row, self.col, chr(k))
         self.col += 1
         self.hidden_col = self.col
         self.refresh()
 
+    # insert text (typed ahead or pasted, maybe several lines) in one go
+    def insert_text(self, text):
+        # tabs as spaces, like tab(), and cursor after the text
+        self.row, self.col = self.lines.insert(self.row, self.col,
+                text.replace('\t', ' '*4))
+        self.hidden_col = self.col
+        self.refresh()
+
     def insert_link(self, link):
-        self.lines[self.row] = self.lines[self.row][:self.col] \
-                + link \
-                + self.lines[self.row][self.col:]
+        self.lines.insert(self.row, self.col, link)
         self.col += len(link)
         self.hidden_col = self.col
         self.refresh()
 
+    def undo(self):
+        cursor = self.history.undo(self.lines)
+        if cursor: # back to where the edit was
+            self.row, self.col = cursor
+            self.hidden_col = self.col
+        self.refresh()
+
+    def redo(self):
+        cursor = self.history.redo(self.lines)
+        if cursor:
+            self.row, self.col = cursor
+            self.hidden_col = self.col
+        self.refresh()
+
     def resize(self, rows,cols, y,x ):
         oldwin = self.win
         self.win = curses.newwin( rows,cols, y,x )
         del oldwin
         self.rows, self.cols = self.win.getmaxyx()
+        self.layout.resize(self.cols)
         self.refresh()
 
     def keypress(self, k):
@@ -410,6 +521,7 @@ class Editor:
         elif k == Keys.CTRL_n:      flag, val = 'new', None
         elif k == Keys.CTRL_o:      flag, val = self.to_viewer()
         elif k == Keys.CTRL_q:      flag, val = 'quit', None
+        elif k == Keys.CTRL_r:      self.redo()
         elif k == Keys.CTRL_s:      self.save()
         elif k == Keys.CTRL_u:
             for _ in range(10):
@@ -417,6 +529,7 @@ class Editor:
         elif k == Keys.CTRL_v:      self.paste()
         elif k == Keys.CTRL_w:      flag, val = self.close()
         elif k == Keys.CTRL_x:      self.cut()
+        elif k == Keys.CTRL_SLASH:  self.undo()
         elif k == Keys.CTRL_UP:     flag, val = 'window_up', None
         elif k == Keys.CTRL_DOWN:   flag, val = 'window_down', None
         elif k == Keys.CTRL_SHIFT_UP:    flag, val = 'expand', 'vertical'
@@ -0,0 +1,123 @@
+############################################################################
+#
+#   FileLayout.py
+#       rows taken up by the lines of a big file (see FileLines), like
+#       LineLayout but working out each block of lines only once it's
+#       looked at or edited
+#
+############################################################################
+
+import bisect
+import itertools
+from LineLayout import LineLayout
+
+class FileLayout:
+    def __init__(self, lines, cols):
+        # width of window lines are wrapped to
+        self.cols = cols
+        # FileLines being laid out, which hasn't been edited yet
+        self.file = lines
+        # each block of lines: a LineLayout once looked at, until then the
+        #   number of the block in self.file, whose lines it still has
+        self.blocks = list(range(len(lines.offsets) - 1)) \
+                or [LineLayout([0], cols)]
+        self.build()
+
+    # (re)build from self.blocks, O(number of blocks)
+    def build(self):
+        # lines in each block, and line each starts at, plus the total
+        sizes = [self.size(block) for block in self.blocks]
+        self.firsts = [0] + list(itertools.accumulate(sizes))
+        # rows taken up by each block, laid out with 1 column so rows count
+        #   as lengths, to find where blocks start and which row is in which
+        self.tree = LineLayout((self.block_rows(block)
+                for block in self.blocks), 1)
+
+    def size(self, block):
+        if isinstance(block, LineLayout):
+            return len(block)
+        return self.file.firsts[block+1] - self.file.firsts[block]
+
+    # rows taken up by block, guessed from its size in bytes until it's
+    #   looked at
+    def block_rows(self, block):
+        if isinstance(block, LineLayout):
+            return block.total()
+        size = self.file.offsets[block+1] - self.file.offsets[block]
+        return max(self.size(block), -(size // -self.cols))
+
+    def __len__(self):
+        return self.firsts[-1]
+
+    # LineLayout of block k, laying it out from the file if it isn't yet
+    def visit(self, k):
+        block = self.blocks[k]
+        if not isinstance(block, LineLayout):
+            lengths = (len(line) for line in self.file.block(block))
+            block = self.blocks[k] = LineLayout(lengths, self.cols)
+            self.tree.set(k, block.total())
+        return block
+
+    # block line i is in, and where in it, lines past the end are in the
+    #   last block
+    def locate(self, i):
+        k = min(bisect.bisect_right(self.firsts, i), len(self.blocks)) - 1
+        return k, i - self.firsts[k]
+
+    # wrap to a different width, laying out again only blocks looked at
+    def resize(self, cols):
+        if cols != self.cols:
+            self.cols = cols
+            for block in self.blocks:
+                if isinstance(block, LineLayout):
+                    block.resize(cols)
+            self.build()
+
+    # line i changed to length
+    def set(self, i, length):
+        k, j = self.locate(i)
+        block = self.visit(k)
+        block.set(j, length)
+        self.tree.set(k, block.total())
+
+    # lines i up to j replaced by lines of lengths, blocks they span are
+    #   joined into one
+    def splice(self, i, j, lengths):
+        lengths = list(lengths)
+        k, offset = self.locate(i)
+        last = self.locate(j - 1)[0] if j > i else k
+        if last == k and len(lengths) == j - i:
+            block = self.visit(k)
+            block.splice(offset, offset + j - i, lengths)
+            self.tree.set(k, block.total())
+            return
+        joined = []
+        for m in range(k, last + 1):
+            joined += self.visit(m).lengths
+        block = LineLayout(joined, self.cols)
+        block.splice(offset, offset + j - i, lengths)
+        self.blocks[k:last+1] = [block] if len(block) else []
+        self.build()
+
+    # first row of line i
+    def start(self, i):
+        if i >= len(self):
+            return self.total()
+        k, j = self.locate(i)
+        block = self.visit(k)
+        return self.tree.start(k) + block.start(j)
+
+    # rows taken up by all lines, guessed for blocks not looked at
+    def total(self):
+        return self.tree.total()
+
+    # line that row is in, and the row within that line
+    # rows past the end are in the last line
+    def find(self, row):
+        while True:
+            k, rest = self.tree.find(row)
+            if isinstance(self.blocks[k], LineLayout):
+                break
+            self.visit(k)   # rows may move, look again
+        line, rest = self.blocks[k].find(rest)
+        return self.firsts[k] + line, rest
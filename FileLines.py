@@ -0,0 +1,254 @@
+############################################################################
+#
+#   FileLines.py
+#       lines of a big file for Editor, memory-mapped and decoded a block at
+#       a time as they're looked at, rather than read in all at once
+#
+############################################################################
+
+import bisect
+import codecs
+import locale
+import itertools
+from collections import OrderedDict
+
+# bytes of file to a block, blocks end at the end of a line
+block_size = 1 << 16
+# number of blocks kept decoded
+cached_blocks = 16
+
+# whether data is valid UTF-8
+def valid(data):
+    try:
+        data.decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+    return True
+
+# works like the list of lines TextBuffer keeps (without trailing newlines),
+#   for the operations it uses: indexing and slicing, assigning to and
+#   deleting them, append, len and iterating
+# lines end in \n (or \r\n), like split_lines but without universal newlines
+class FileLines:
+    def __init__(self, data, encoding=None):
+        # file contents, e.g. an mmap
+        self.data = data
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        # flag for the file being exactly the text of its lines, as UTF-8
+        #   with \n line ends, so it can be hashed as it is (see
+        #   Editor.digest) rather than decoded and put together
+        self.exact = codecs.lookup(self.encoding).name == 'utf-8'
+        # blocks of the file: byte offset each starts at, and line each
+        #   starts at, plus the end of the file after the last one
+        self.offsets = [0]
+        self.firsts = [0]
+        self.index()
+        # decoded blocks, block -> list of lines, most recently used last
+        self.decoded = OrderedDict()
+        # lines as pieces, each a range of lines of the file (not edited)
+        #   or a list of lines (edited)
+        self.pieces = [range(self.firsts[-1])] if self.firsts[-1] else [['']]
+        # line each piece starts at, plus the number of lines
+        self.starts = None
+        self.count()
+
+    # split file into blocks and count the lines in each, without keeping
+    #   anything decoded (bytes.count does the counting, in C)
+    def index(self):
+        size = len(self.data)
+        start = 0
+        lines = 0
+        while start < size:
+            end = self.data.find(b'\n', start + block_size - 1) + 1 or size
+            data = self.data[start:end]
+            lines += data.count(b'\n')
+            if self.exact:
+                self.exact = b'\r' not in data and valid(data)
+            if self.data[end-1:end] != b'\n': # last line, without a newline
+                lines += 1
+            self.offsets.append(end)
+            self.firsts.append(lines)
+            start = end
+
+    # lines in block b, decoded, keeping the last few decoded
+    def block(self, b):
+        if b in self.decoded:
+            self.decoded.move_to_end(b)
+            return self.decoded[b]
+        data = self.data[self.offsets[b]:self.offsets[b+1]]
+        text = data.decode(self.encoding, 'replace')
+        lines = text.split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        if '\r' in text:
+            lines = [line[:-1] if line.endswith('\r') else line
+                    for line in lines]
+        self.decoded[b] = lines
+        if len(self.decoded) > cached_blocks:
+            self.decoded.popitem(last=False)
+        return lines
+
+    # lines of the file in range lines, as a list for each block they're in
+    def file_lines(self, lines):
+        f = lines.start
+        while f < lines.stop:
+            b = bisect.bisect_right(self.firsts, f) - 1
+            end = min(lines.stop, self.firsts[b+1])
+            yield self.block(b)[f - self.firsts[b]:end - self.firsts[b]]
+            f = end
+
+    # work out where pieces start, after they change
+    def count(self):
+        self.starts = [0] + list(itertools.accumulate(map(len, self.pieces)))
+
+    def __len__(self):
+        return self.starts[-1]
+
+    # piece line i is in, and where in it
+    def find(self, i):
+        k = bisect.bisect_right(self.starts, i) - 1
+        return k, i - self.starts[k]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, _ = i.indices(len(self))
+            return self.get(start, stop)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('line index out of range')
+        k, j = self.find(i)
+        piece = self.pieces[k]
+        if isinstance(piece, range):
+            return next(self.file_lines(piece[j:j+1]))[0]
+        return piece[j]
+
+    # lines i up to j, as a list
+    def get(self, i, j):
+        result = []
+        while i < j:
+            k, offset = self.find(i)
+            part = self.pieces[k][offset:offset + j - i]
+            if isinstance(part, range):
+                for lines in self.file_lines(part):
+                    result += lines
+            else:
+                result += part
+            i += len(part)
+        return result
+
+    def __iter__(self):
+        for piece in self.pieces:
+            if isinstance(piece, range):
+                for lines in self.file_lines(piece):
+                    yield from lines
+            else:
+                yield from piece
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            start, stop, _ = i.indices(len(self))
+            self.splice(start, stop, list(value))
+        else:
+            if i < 0:
+                i += len(self)
+            self.splice(i, i+1, [value])
+
+    def __delitem__(self, i):
+        start, stop, _ = i.indices(len(self))
+        self.splice(start, stop, [])
+
+    def append(self, line):
+        self.splice(len(self), len(self), [line])
+
+    # replace lines i up to j with lines, O(number of pieces)
+    def splice(self, i, j, lines):
+        a = self.split(i)
+        b = self.split(j)
+        self.pieces[a:b] = [lines] if lines else []
+        self.count()
+
+    # make a piece start at line i, return which one it is
+    def split(self, i):
+        if i >= len(self):
+            return len(self.pieces)
+        k, j = self.find(i)
+        if j == 0:
+            return k
+        piece = self.pieces[k]
+        self.pieces[k:k+1] = [piece[:j], piece[j:]]
+        self.count()
+        return k + 1
+
+# check against a plain list of lines (and FileLayout against LineLayout),
+#   on random files and edits, with tiny blocks so there are lots of them
+if __name__ == '__main__':
+    import random
+    from LineLayout import LineLayout
+    from FileLayout import FileLayout
+
+    # lines of data the way split_lines would have them, with \r\n too
+    def reference(data):
+        lines = data.decode('utf-8', 'replace').split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        lines = [line[:-1] if line.endswith('\r') else line
+                for line in lines]
+        return lines or ['']
+
+    block_size = 16
+    cached_blocks = 2
+    random.seed(0)
+    for trial in range(300):
+        n = random.choice([0, 1, 2, 5, 30])
+        data = b'\n'.join(bytes(random.choice(b'ab ')
+                for _ in range(random.choice([0, 3, 10, 25])))
+                for _ in range(n))
+        if random.random() < 0.5:
+            data += b'\n'
+        if random.random() < 0.2:
+            data = data.replace(b'\n', b'\r\n')
+        if random.random() < 0.2:
+            data = data.replace(b'a', 'ü'.encode(), 1)
+        if random.random() < 0.1:
+            data = data.replace(b'b', b'\xff', 1)
+        lines = FileLines(data, 'utf-8')
+        expected = reference(data)
+        assert list(lines) == expected, (trial, data)
+        text = '\n'.join(expected) + '\n'
+        assert lines.exact == (data in (text.encode(), text[:-1].encode())), \
+                (trial, data)
+        cols = random.choice([1, 4, 10])
+        layout = FileLayout(lines, cols)
+        for k in range(len(layout.blocks)):
+            layout.visit(k)
+        for step in range(30):
+            i = random.randint(0, len(expected))
+            j = random.randint(i, min(len(expected), i + 3))
+            new = ['x' * random.randint(0, 12)
+                    for _ in range(random.randint(0, 3))]
+            op = random.random()
+            if op < 0.3 and i < len(expected):
+                lines[i] = expected[i] = new[0] if new else ''
+                layout.set(i, len(expected[i]))
+            elif op < 0.4:
+                lines.append('y')
+                expected.append('y')
+                layout.splice(len(layout), len(layout), [1])
+            else:
+                if j - i == len(expected) and not new:
+                    new = ['']  # TextBuffer always keeps a line
+                lines[i:j] = new
+                expected[i:j] = new
+                layout.splice(i, j, map(len, new))
+            assert list(lines) == expected, (trial, step)
+            a, b = random.randint(0, len(expected)), random.randint(0, 5)
+            assert lines[a:a+b] == expected[a:a+b], (trial, step)
+            check = LineLayout(map(len, expected), cols)
+            assert len(layout) == len(check) and \
+                    layout.total() == check.total(), (trial, step)
+            for row in range(check.total() + 2):
+                assert layout.find(row) == check.find(row), (trial, step)
+            for i in range(len(expected) + 1):
+                assert layout.start(i) == check.start(i), (trial, step)
+    print('ok')
@@ -0,0 +1,67 @@
+############################################################################
+#
+#   IDAllocator.py
+#       hand out new zettel IDs from a persistent per-day counter, safe
+#       between processes
+#
+############################################################################
+
+import datetime
+import fcntl
+import config
+import utils
+
+class IDAllocator:
+    def __init__(self, filepath=None):
+        # counter file, holding the last ID handed out
+        self.filepath = filepath or config.id_counter
+
+    # today's date as at the start of an ID
+    def today(self):
+        return datetime.date.today().isoformat().replace('-','')[2:]
+
+    # last ID handed out today, per counter file contents, or else per the
+    #   zettel already in the kasten (first time today, or no counter yet)
+    def last(self, counter, YYMMDD):
+        if counter.startswith(YYMMDD):
+            return counter
+        IDs = utils.storage().IDs_starting(YYMMDD)
+        if counter and counter[:6] > YYMMDD:
+            # clock went backwards, keep counting from the later date
+            IDs.append(counter)
+        if not IDs:
+            return ''
+        return max(IDs, key=utils.ID_sort)
+
+    # create n new (empty) zettel, return their IDs in order
+    # each is created exclusively, so IDs taken in the meantime (e.g. by a
+    #   sync) are skipped rather than overwritten
+    def allocate(self, n=1):
+        IDs = []
+        with open(self.filepath, 'a+') as f:
+            # hold lock on counter while creating, other processes wait
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                counter = f.read().strip()
+                YYMMDD = self.today()
+                last = self.last(counter, YYMMDD)
+                while len(IDs) < n:
+                    # YYMMDD followed by letters a, b, ..., z, aa, ab, ...
+                    if last:
+                        ID = last[:6] + utils.increment_letters(last[6:])
+                    else:
+                        ID = YYMMDD + 'a'
+                    last = ID
+                    try:
+                        utils.storage().create(ID)
+                    except FileExistsError:
+                        continue
+                    IDs.append(ID)
+                f.seek(0)
+                f.truncate()
+                f.write(last + '\n')
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return IDs
@@ -10,6 +10,7 @@ import curses
 import config
 import utils
 from Keys import Keys
+from SearchWorker import SearchWorker
 
 class Index:
     def __init__(self, win):
@@ -23,6 +24,12 @@ class Index:
         self.top = 0
         # flag for search in progress
         self.searching = False
+        # search-as-you-type session while searching
+        self.search_session = None
+        # background thread running searches, started on first search
+        self.search_worker = None
+        # flag for showing search results rather than the whole kasten
+        self.filtered = False
         # flag for command in progress
         self.command_mode = False
         # flag for preview mode
@@ -53,17 +60,48 @@ class Index:
 
     def start_search(self):
         self.searching = True
+        if self.search_worker:
+            self.search_worker.cancel()
+        # pick up any changes since the last search
+        utils.update_search_index()
+        self.search_session = utils.search_session()
 
     def end_search(self):
         self.searching = False
+        self.search_session = None
         return self.active_ID()
 
+    # start search in the background, results come in through poll_search
     def search(self, text):
-        self.zett = utils.search_IDs_titles(text)
+        if not self.search_worker:
+            self.search_worker = SearchWorker()
+        self.search_worker.submit(self.search_session, text)
+        self.filtered = True
         self.top = 0 # make sure we see search results
-        if self.row >= len(self.zett): # move cursor up if it fell off
-            self.row = max(0, len(self.zett) - 1)
-        self.refresh()
+        self.poll_search()
+
+    # pick up results from background search, return True if any came in
+    def poll_search(self):
+        if not self.search_worker:
+            return False
+        IDs, done = self.search_worker.poll()
+        # nothing to show once search was cancelled, the list has moved on
+        if IDs is None:
+            return False
+        # keep showing old results until there's something new to show
+        if not (IDs or done):
+            return False
+        if [zettel['ID'] for zettel in self.zett] != IDs:
+            index = utils.search_index()
+            self.zett = [{'ID': ID, 'TITLE': index.title(ID)} for ID in IDs]
+            if self.row >= len(self.zett): # move cursor up if it fell off
+                self.row = max(0, len(self.zett) - 1)
+            self.refresh()
+            return True
+        return False
+
+    def search_pending(self):
+        return self.search_worker is not None and not self.search_worker.done
 
     def start_command(self):
         self.command_mode = True
@@ -82,18 +120,43 @@ class Index:
         self.refresh()
 
     def update_list(self, sync=False):
-        if sync and config.kasten_sync:
-            try:
-                self.win.addstr(0,0," syncing ... ",curses.A_REVERSE)
-                self.win.refresh()
-            except curses.error:
-                pass
-            utils.sync()
+        if sync:
+            utils.sync() # in the background, changes come in via Watcher
+        if self.search_worker: # don't let search results overwrite the list
+            self.search_worker.cancel()
         self.zett = utils.list_IDs_titles()
+        self.filtered = False
         self.refresh()
 
+    # update list for zettel changed or deleted behind our back
+    def apply_changes(self, changed, deleted):
+        gone = set(deleted)
+        listed = {zettel['ID']: zettel for zettel in self.zett}
+        for ID in changed:
+            try:
+                title = utils.meta_cache().title(ID)
+            except FileNotFoundError:
+                gone.add(ID)
+                continue
+            if ID in listed:
+                listed[ID]['TITLE'] = title
+            elif not self.filtered: # don't add to search results
+                self.zett.append({'ID': ID, 'TITLE': title})
+        if gone:
+            self.zett = [zettel for zettel in self.zett
+                    if zettel['ID'] not in gone]
+            if self.row >= len(self.zett): # move cursor up if it fell off
+                self.row = max(0, len(self.zett) - 1)
+        self.refresh()
+
+    # mark window to be drawn with the next frame, see WindowStack.render
     def refresh(self):
-        self.win.clear()
+        self.dirty = True
+
+    def render(self):
+        self.dirty = False
+        # erase rather than clear, which would repaint the whole terminal
+        self.win.erase()
         # for each visible line
         for i in range(self.top, min(self.top+self.rows, len(self.zett))):
             # i = row in zettel list, j = row in window
@@ -107,7 +170,7 @@ class Index:
             else:
                 self.win.insstr( j,0, self.zett[i]['ID'].ljust(9))
         curses.curs_set(0) # hide cursor
-        self.win.refresh()
+        self.win.noutrefresh() # to screen on the next curses.doupdate()
 
     def resize(self, screen_rows, screen_cols):
         self.rows, self.cols = screen_rows - 1, screen_cols
@@ -0,0 +1,120 @@
+############################################################################
+#
+#   Input.py
+#       keys from the terminal, taking text typed ahead or pasted in one
+#       piece for editors
+#
+############################################################################
+
+import sys
+import collections
+from Keys import Keys
+
+# escape sequences to turn bracketed paste on and off, with it on the
+#   terminal sends pasted text between ESC[200~ and ESC[201~
+paste_on = '\x1b[?2004h'
+paste_off = '\x1b[?2004l'
+paste_start = [ord(c) for c in '[200~'] # after ESC
+paste_end = [Keys.ESC] + [ord(c) for c in '[201~']
+
+# tell terminal to bracket pasted text (or not), terminals that don't know
+#   how just ignore this
+def bracketed_paste(on=True):
+    sys.stdout.write(paste_on if on else paste_off)
+    sys.stdout.flush()
+
+# keys that are part of text, rather than commands: printable characters,
+#   bytes of UTF-8 encoded characters, newlines and tabs
+def is_text(k):
+    return 32 <= k <= 126 or 128 <= k <= 255 \
+            or k == Keys.RETURN or k == Keys.TAB
+
+class Input:
+    def __init__(self, screen, paste_timeout=1000):
+        self.screen = screen
+        # keys taken from the terminal but not used yet
+        self.pending = collections.deque()
+        # milliseconds to wait for the rest of a paste before giving up
+        self.paste_timeout = paste_timeout
+        # milliseconds getch() waits for a key, see timeout()
+        self.delay = -1
+
+    # like screen.timeout, wait at most ms milliseconds for a key, 0 for
+    #   not at all, -1 for as long as it takes
+    def timeout(self, ms):
+        self.delay = ms
+        self.screen.timeout(ms)
+
+    # next key, or -1 if none came in time
+    # when text is True, text typed ahead (or pasted) comes as one str
+    #   instead, so an editor can take it in one go
+    def getch(self, text=False):
+        k = self.next_key()
+        if k == Keys.ESC and self.expect(paste_start):
+            pasted = self.paste()
+            if text:
+                return self.decode(pasted)
+            # not for an editor, so just keys like any others
+            self.pending.extend(pasted)
+            return self.next_key()
+        if text and k != -1 and is_text(k):
+            keys = [k]
+            while True:
+                k = self.next_key(wait=False)
+                if k == -1:
+                    break
+                if not is_text(k):
+                    self.pending.appendleft(k) # for next time
+                    break
+                keys.append(k)
+            return self.decode(keys)
+        return k
+
+    # next key from pending or from the terminal, -1 if none
+    # wait=False doesn't wait for the terminal, just takes what's there
+    def next_key(self, wait=True):
+        if self.pending:
+            return self.pending.popleft()
+        if wait or self.delay == 0:
+            return self.screen.getch()
+        self.screen.timeout(0)
+        k = self.screen.getch()
+        self.screen.timeout(self.delay)
+        return k
+
+    # check whether keys waiting (already there) are sequence, taking them
+    #   if so and leaving them otherwise
+    def expect(self, sequence):
+        keys = []
+        for expected in sequence:
+            k = self.next_key(wait=False)
+            if k != -1:
+                keys.append(k)
+            if k != expected:
+                self.pending.extendleft(reversed(keys))
+                return False
+        return True
+
+    # keys of pasted text, up to the closing ESC[201~ (or until the
+    #   terminal goes quiet, if it never comes)
+    def paste(self):
+        keys = []
+        self.screen.timeout(self.paste_timeout)
+        while keys[-len(paste_end):] != paste_end:
+            k = self.next_key()
+            if k == -1:
+                break
+            keys.append(k)
+        else:
+            del keys[-len(paste_end):]
+        self.screen.timeout(self.delay)
+        return keys
+
+    # str from keys, which are bytes of UTF-8 text as far as curses is
+    #   concerned, leaving out control characters other than newlines and
+    #   tabs
+    def decode(self, keys):
+        data = bytes(k for k in keys if 0 <= k <= 255)
+        text = data.decode('utf-8', 'replace')
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+        return ''.join(c for c in text if c >= ' ' or c in '\n\t')
@@ -0,0 +1,125 @@
+############################################################################
+#
+#   Journal.py
+#       edits made in an editor since its zettel was last saved, appended
+#       to a file as they happen, to get them back if zk dies first
+#
+############################################################################
+
+import os
+import json
+import time
+import itertools
+import config
+
+# journals are files in config.journal_dir named ID.pid.n, for editor n on
+#   zettel ID in process pid, holding a line of JSON with the ID and hash of
+#   the text edits were made to, then a line for each edit (see UndoLog)
+serial = itertools.count()
+
+# journals left behind by zk processes that are gone, i.e. editors that
+#   never closed, as a list of (ID, path)
+def leftover_journals():
+    try:
+        names = os.listdir(config.journal_dir)
+    except FileNotFoundError:
+        return []
+    journals = []
+    for name in sorted(names):
+        if name.startswith('.'):
+            continue    # set aside, see set_aside
+        try:
+            ID, pid, n = name.rsplit('.', 2)
+            pid = int(pid)
+        except ValueError:
+            continue    # not a journal
+        if pid != os.getpid() and alive(pid):
+            continue
+        journals.append((ID, config.journal_dir + name))
+    return journals
+
+# whether process pid is still running (i.e. another zk, still editing)
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+# edits in journal at path, or None if they weren't made to text with hash
+# a last line cut short (zk died while writing it) is left out
+def replay(path, text_hash):
+    with open(path, 'r') as f:
+        lines = f.read().split('\n')
+    try:
+        if json.loads(lines[0])['hash'] != text_hash:
+            return None
+    except (ValueError, KeyError):
+        return None
+    edits = []
+    for line in lines[1:]:
+        try:
+            kind, row, col, text = json.loads(line)
+        except ValueError:
+            break
+        if isinstance(text, list):  # lines, recorded as a tuple
+            text = tuple(text)
+        edits.append((kind, row, col, text))
+    return edits
+
+# keep journal that couldn't be replayed out of the way, as a dotfile
+def set_aside(path):
+    directory, name = os.path.split(path)
+    os.replace(path, os.path.join(directory, '.' + name))
+
+class Journal:
+    def __init__(self, ID, text_hash):
+        self.ID = ID
+        self.path = f'{config.journal_dir}{ID}.{os.getpid()}.{next(serial)}'
+        # hash of text the edits are made to, see Editor.digest
+        self.text_hash = text_hash
+        # file being written, opened on the first edit, so editors that
+        #   never change anything leave nothing behind
+        self.file = None
+        # flag for edits written but not yet synced to disk
+        self.pending = False
+        # time.monotonic() of last fsync
+        self.synced = 0
+
+    # record edit (see UndoLog), called by TextBuffer
+    # only buffered here, see flush()
+    def record(self, edit):
+        if self.file is None:
+            os.makedirs(config.journal_dir, exist_ok=True)
+            self.file = open(self.path, 'w')
+            header = {'ID': self.ID, 'hash': self.text_hash}
+            self.file.write(json.dumps(header) + '\n')
+        self.file.write(json.dumps(edit) + '\n')
+        self.pending = True
+
+    # hand edits recorded since last time to the OS, which has them even if
+    #   zk dies, and get them onto the disk every config.journal_interval
+    #   seconds, for the OS dying too
+    def flush(self):
+        if not self.pending:
+            return
+        self.file.flush()
+        if time.monotonic() - self.synced >= config.journal_interval:
+            os.fsync(self.file.fileno())
+            self.synced = time.monotonic()
+            self.pending = False
+
+    # zettel saved as text with text_hash, edits so far are safe
+    def restart(self, text_hash):
+        self.close()
+        self.text_hash = text_hash
+
+    # done with edits, whether saved or thrown away
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.remove(self.path)
+        self.pending = False
@@ -0,0 +1,122 @@
+############################################################################
+#
+#   KastenQuery.py
+#       queries on the kasten for code in zettel, answered from the
+#       indexes rather than by reading every file
+#
+############################################################################
+
+import bisect
+import datetime
+import utils
+
+# available to code in zettel as `kasten`, e.g.
+#   for ID in kasten.backlinks(kasten.here):
+#       print('#' + ID, kasten.title(ID))
+#   print(len(kasten.between('230101', '230131')), 'zettel in January')
+# what the code worker learns about the kasten (IDs, titles) is kept
+#   between runs, and brought up to date from changes the UI noticed (see
+#   CodeRunner.note) rather than by rescanning the kasten each run
+# indexes are only read here, the UI keeps them up to date and saves them
+#   before each run (see CodeRunner.run)
+class KastenQuery:
+    def __init__(self):
+        # ID of zettel whose code is running
+        self.here = None
+        # all IDs in order, their sort keys and dates (YYMMDD), worked out
+        #   the first time they're needed
+        self.sorted_IDs = None
+        self.keys = None
+        self.dates = None
+        # link graph and search index, opened the first time they're needed
+        self.link_graph = None
+        self.search_index = None
+
+    # get ready for a run of code in zettel ID, given changes to the kasten
+    #   since the last run, dict of ID -> flag for deleted, or None if the
+    #   UI lost track of them
+    def start(self, ID, changes=None):
+        self.here = ID
+        if changes is None:
+            # catch up from scratch, as things are needed
+            utils.meta_cache().clear()
+            self.sorted_IDs = self.keys = self.dates = None
+        elif changes:
+            self.apply(changes)
+
+    def apply(self, changes):
+        cache = utils.meta_cache()
+        for ID in changes:
+            cache.forget(ID)    # reread title on next lookup
+        if self.sorted_IDs is not None and len(changes) > 100:
+            # cheaper to sort them all again than insert one by one
+            self.sorted_IDs = self.keys = self.dates = None
+        if self.sorted_IDs is not None:
+            for ID, deleted in changes.items():
+                key = utils.ID_sort(ID)
+                i = bisect.bisect_left(self.keys, key)
+                present = i < len(self.keys) and self.keys[i] == key
+                if deleted and present:
+                    del self.sorted_IDs[i], self.keys[i], self.dates[i]
+                elif not deleted and not present:
+                    self.sorted_IDs.insert(i, ID)
+                    self.keys.insert(i, key)
+                    self.dates.insert(i, key[0])
+
+    # all IDs, in order
+    def IDs(self):
+        if self.sorted_IDs is None:
+            self.sorted_IDs = sorted(utils.meta_cache().validate(),
+                    key=utils.ID_sort)
+            self.keys = [utils.ID_sort(ID) for ID in self.sorted_IDs]
+            self.dates = [key[0] for key in self.keys]
+        return list(self.sorted_IDs)
+
+    # straight from the title cache, reading the zettel only if it isn't
+    #   there (or changed)
+    def title(self, ID):
+        return utils.get_title(ID)
+
+    # dict of ID -> title, for IDs (by default, all of them)
+    def titles(self, IDs=None):
+        if IDs is None:
+            IDs = self.IDs()
+        return {ID: self.title(ID) for ID in IDs}
+
+    def graph(self):
+        if self.link_graph is None:
+            self.link_graph = utils.storage().link_graph()
+        return self.link_graph
+
+    # IDs of zettel that ID links to
+    def links(self, ID):
+        return self.graph().links(ID)
+
+    # IDs of all zettel that link to ID, in order
+    # (unlike backlinks in a viewer, which leave out those ID links back to)
+    def backlinks(self, ID):
+        return self.graph().linking_to(ID)
+
+    # IDs of zettel matching search text, as typed in the index window
+    #   (start with '/' to only search titles, '#' for IDs)
+    def search(self, search_text):
+        if self.search_index is None:
+            self.search_index = utils.storage().search_index()
+        return self.search_index.query(search_text)
+
+    # IDs of zettel from dates start to end (inclusive), each a date or
+    #   'YYMMDD', by default from the beginning or up to the end
+    def between(self, start=None, end=None):
+        self.IDs()
+        lo = 0
+        hi = len(self.sorted_IDs)
+        if start is not None:
+            lo = bisect.bisect_left(self.dates, self.YYMMDD(start))
+        if end is not None:
+            hi = bisect.bisect_right(self.dates, self.YYMMDD(end))
+        return self.sorted_IDs[lo:hi]
+
+    def YYMMDD(self, date):
+        if isinstance(date, (datetime.date, datetime.datetime)):
+            return date.strftime('%y%m%d')
+        return date
@@ -17,12 +17,14 @@ class Keys:
     CTRL_n = 14
     CTRL_o = 15
     CTRL_q = 17
+    CTRL_r = 18
     CTRL_s = 19
     CTRL_u = 21
     CTRL_v = 22
     CTRL_w = 23
     CTRL_x = 24
     ESC = 27
+    CTRL_SLASH = 31
     SPACE = 32
     SHIFT_LEFT = 393
     SHIFT_RIGHT = 402
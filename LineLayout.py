@@ -0,0 +1,99 @@
+############################################################################
+#
+#   LineLayout.py
+#       rows taken up by lines of text wrapped to a window width, with a
+#       Fenwick tree to find where a line starts or which line a row is in
+#       without adding them all up
+#
+############################################################################
+
+import itertools
+
+class LineLayout:
+    def __init__(self, lengths, cols):
+        # width of window lines are wrapped to
+        self.cols = cols
+        # length of each line
+        self.lengths = list(lengths)
+        self.build()
+
+    # rows taken up by a line of length, an empty line still takes a row
+    def wrapped(self, length):
+        return max(1, -(length // -self.cols)) # ceiling division
+
+    # (re)build from self.lengths, O(n)
+    def build(self):
+        # rows taken up by each line
+        self.counts = [self.wrapped(length) for length in self.lengths]
+        # Fenwick tree, 1-indexed: tree[i] holds the rows of lines
+        #   i - lowbit(i) up to i - 1, where lowbit(i) = i & -i
+        starts = [0] + list(itertools.accumulate(self.counts))
+        self.tree = [0] + [starts[i] - starts[i & (i-1)]
+                for i in range(1, len(starts))]
+        # highest power of 2 up to len(self), to search the tree from
+        self.step = 1 << (len(self.counts).bit_length() - 1) \
+                if self.counts else 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    # wrap to a different width, rebuilding only if it changed
+    def resize(self, cols):
+        if cols != self.cols:
+            self.cols = cols
+            self.build()
+
+    # rows taken up by line i
+    def rows(self, i):
+        return self.counts[i]
+
+    # line i changed to length, O(log n)
+    def set(self, i, length):
+        self.lengths[i] = length
+        delta = self.wrapped(length) - self.counts[i]
+        if delta:
+            self.counts[i] += delta
+            i += 1
+            while i < len(self.tree):
+                self.tree[i] += delta
+                i += i & -i
+
+    # lines i up to j replaced by lines of lengths, O(log n) per line if
+    #   the number of lines stays the same, O(n) if not
+    def splice(self, i, j, lengths):
+        lengths = list(lengths)
+        if len(lengths) == j - i:
+            for k, length in enumerate(lengths):
+                self.set(i + k, length)
+        else:
+            self.lengths[i:j] = lengths
+            self.build()
+
+    # first row of line i, i.e. rows taken up by lines before it, O(log n)
+    def start(self, i):
+        i = min(i, len(self.counts))
+        row = 0
+        while i > 0:
+            row += self.tree[i]
+            i &= i - 1
+        return row
+
+    # rows taken up by all lines
+    def total(self):
+        return self.start(len(self.counts))
+
+    # line that row is in, and the row within that line, O(log n)
+    # rows past the end are in the last line
+    def find(self, row):
+        i = 0   # lines before i take up less than row + 1 rows
+        rest = row
+        step = self.step
+        while step:
+            if i + step <= len(self.counts) and self.tree[i + step] <= rest:
+                i += step
+                rest -= self.tree[i]
+            step >>= 1
+        if i >= len(self.counts): # past the end
+            i = max(0, len(self.counts) - 1)
+            rest = row - self.start(i)
+        return i, rest
@@ -0,0 +1,108 @@
+############################################################################
+#
+#   LinkGraph.py
+#       persistent graph of links between zettel, forward and reverse
+#
+############################################################################
+
+import re
+import config
+import utils
+
+# bump when the on-disk format changes, old graphs get rebuilt
+VERSION = 2
+
+# regex to match links in notes
+link_re = re.compile(r'#(\d+[a-z]+)')
+
+# IDs linked to in text, in order of first appearance
+def find_links(text):
+    return tuple(dict.fromkeys(link_re.findall(text)))
+
+# a row in docs for each zettel whose links were read, and in links for
+#   each link, looked up by src for links and by dst for backlinks
+schema = '''
+    CREATE TABLE IF NOT EXISTS docs (
+        ID TEXT PRIMARY KEY,
+        mtime INTEGER NOT NULL,
+        size INTEGER NOT NULL);
+    CREATE TABLE IF NOT EXISTS links (
+        src TEXT NOT NULL,
+        dst TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        PRIMARY KEY (src, dst)) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS links_dst ON links (dst, src);
+    '''
+
+# kept in a SQLite database (see utils.index_db), like SearchIndex
+class LinkGraph:
+    def __init__(self, filepath=None):
+        # where the graph is saved, by default next to .stack_save
+        self.filepath = filepath or config.link_graph
+        self.db = utils.index_db(self.filepath, VERSION, schema)
+
+    def rows(self, sql, args=()):
+        return self.db.execute(sql, args).fetchall()
+
+    # changes go into a transaction, left open until save()
+    def begin(self):
+        if not self.db.in_transaction:
+            self.db.execute('BEGIN')
+
+    # commit changes made since last time, O(number of changes)
+    def save(self):
+        if self.db.in_transaction:
+            self.db.execute('COMMIT')
+
+    # bring graph up to date with kasten, only rereading files whose
+    #   mtime or size changed since their links were read
+    # returns IDs of zettel changed (or new) and of those gone
+    def update(self):
+        snapshot = utils.scan_kasten()
+        docs = {ID: (mtime, size) for ID, mtime, size in
+                self.rows('SELECT ID, mtime, size FROM docs')}
+        gone = [ID for ID in docs if ID not in snapshot]
+        for ID in gone:
+            self.remove(ID)
+        changed = [ID for ID, stat in snapshot.items()
+                if docs.get(ID) != stat]
+        for ID, text in utils.read_zettel(changed).items():
+            self.set_links(ID, find_links(text), snapshot[ID])
+        self.save()
+        return changed, gone
+
+    def set_links(self, ID, links, stat):
+        self.begin()
+        self.db.execute('DELETE FROM links WHERE src = ?', (ID,))
+        self.db.executemany(
+                'INSERT INTO links (src, dst, position) VALUES (?, ?, ?)',
+                [(ID, link_ID, i) for i, link_ID in enumerate(links)])
+        self.db.execute('''INSERT OR REPLACE INTO docs (ID, mtime, size)
+                VALUES (?, ?, ?)''', (ID, *stat))
+
+    def remove(self, ID):
+        self.begin()
+        self.db.execute('DELETE FROM links WHERE src = ?', (ID,))
+        self.db.execute('DELETE FROM docs WHERE ID = ?', (ID,))
+
+    # (mtime, size) of zettel when its links were read, None if they weren't
+    def stat(self, ID):
+        rows = self.rows('SELECT mtime, size FROM docs WHERE ID = ?', (ID,))
+        return rows[0] if rows else None
+
+    # IDs of zettel that ID links to
+    def links(self, ID):
+        return [dst for (dst,) in self.rows(
+            'SELECT dst FROM links WHERE src = ? ORDER BY position', (ID,))]
+
+    # IDs of zettel that link to ID but aren't linked to from ID
+    def backlinks(self, ID):
+        return sorted((src for (src,) in self.rows('''
+                SELECT src FROM links WHERE dst = ?1
+                AND src NOT IN (SELECT dst FROM links WHERE src = ?1)''',
+                (ID,))), key=utils.ID_sort)
+
+    # IDs of all zettel that link to ID
+    def linking_to(self, ID):
+        return sorted((src for (src,) in self.rows(
+            'SELECT src FROM links WHERE dst = ?', (ID,))), key=utils.ID_sort)
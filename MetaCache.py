@@ -0,0 +1,73 @@
+############################################################################
+#
+#   MetaCache.py
+#       in-memory cache of zettel metadata (title, size, mtime)
+#
+############################################################################
+
+from collections import OrderedDict
+import config
+import utils
+
+class MetaCache:
+    def __init__(self, max_entries=None, max_title=None):
+        # ID -> (title, size, mtime), least recently used first
+        self.entries = OrderedDict()
+        # bounds on memory: number of entries and length of each title
+        self.max_entries = max_entries or config.meta_cache_size
+        self.max_title = max_title or config.meta_title_length
+
+    def __contains__(self, ID):
+        return ID in self.entries
+
+    # read title (first line, with newline) from file, bounded in length
+    def read_title(self, ID):
+        title = utils.storage().read_title(ID, self.max_title+1)
+        if len(title) > self.max_title:
+            # keep the newline, so it still looks like a whole line
+            title = title[:self.max_title] + '\n'
+        return title
+
+    def put(self, ID, title, size, mtime):
+        self.entries[ID] = (title, size, mtime)
+        self.entries.move_to_end(ID)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, ID):
+        entry = self.entries.get(ID)
+        if entry is None:
+            # cache miss, go to the file (raises if there is no such zettel)
+            title = self.read_title(ID)
+            mtime, size = utils.storage().stat(ID)
+            self.put(ID, title, size, mtime)
+            return self.entries[ID]
+        self.entries.move_to_end(ID)
+        return entry
+
+    # title with newline, as in the first line of the file
+    def title(self, ID):
+        return self.get(ID)[0]
+
+    def forget(self, ID):
+        self.entries.pop(ID, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    # check cache against kasten with a single scandir pass, rereading only
+    #   titles of zettel that are new or changed
+    # returns the snapshot of the kasten, dict of ID -> (mtime, size)
+    def validate(self):
+        snapshot = utils.scan_kasten()
+        for ID in [ID for ID in self.entries if ID not in snapshot]:
+            del self.entries[ID]
+        changed = [ID for ID, (mtime, size) in snapshot.items()
+                if self.entries.get(ID, (None,))[1:] != (size, mtime)]
+        # skip zettel deleted since the scan
+        titles = utils.read_zettel(changed, self.read_title,
+                skip=FileNotFoundError)
+        for ID, title in titles.items():
+            mtime, size = snapshot[ID]
+            self.put(ID, title, size, mtime)
+        return snapshot
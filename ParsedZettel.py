@@ -0,0 +1,89 @@
+############################################################################
+#
+#   ParsedZettel.py
+#       zettel as shown in a viewer: lines (after running any code) and
+#       links, laid out for a given window width on demand
+#
+############################################################################
+
+import re
+import bisect
+import itertools
+
+# regexes for zk links, hyperlinks, and file links
+ref = re.compile(r'#\d+[a-z]+')
+hyperref = re.compile(r'https?://\S+')
+fileref = re.compile(r'~/[-_a-zA-Z0-9/]+(\.|\*)[a-zA-Z]*')
+
+class ParsedZettel:
+    # how many widths to keep layouts for
+    max_layouts = 4
+
+    def __init__(self, raw_lines):
+        self.raw_lines = raw_lines
+        # links as (line number, start, ID(/url/filepath), kind), in order
+        #   of position in text, kind is None, 'url' or 'file'
+        self.spans = []
+        for i, line in enumerate(raw_lines):
+            spans = [(link.start(), link.group(), None)
+                    for link in ref.finditer(line)]
+            spans += [(link.start(), link.group(), 'url')
+                    for link in hyperref.finditer(line)]
+            spans += [(link.start(), link.group(), 'file')
+                    for link in fileref.finditer(line)]
+            spans.sort()
+            self.spans += [(i, start, ID, kind) for start, ID, kind in spans]
+        # cols -> (starts, links), most recently used last
+        self.layouts = {}
+
+    # layout for window width: first row of each raw line (and after the
+    #   last, the total number of rows), and links with their positions,
+    #   each a dict of ID(/url/filepath), start coords, and a flag for url
+    #   or file
+    # lines themselves are only broken up as they're shown, see lines()
+    # shared between viewers, so don't modify
+    def layout(self, cols):
+        layout = self.layouts.pop(cols, None)
+        if layout is None:
+            layout = self.wrap(cols)
+            while len(self.layouts) >= self.max_layouts:
+                del self.layouts[next(iter(self.layouts))]
+        self.layouts[cols] = layout
+        return layout
+
+    def wrap(self, cols):
+        # rows taken up by each raw line, an empty line still takes a row
+        lengths = [max(1, -(len(line) // -cols)) for line in self.raw_lines]
+        starts = [0] + list(itertools.accumulate(lengths))
+        links = []
+        for i, start, ID, kind in self.spans:
+            link = {
+                'ID': ID,
+                'row': starts[i] + start // cols,
+                'col': start % cols
+                }
+            if kind:
+                link[kind] = True
+            links.append(link)
+        return starts, links
+
+    # lines of window width from row top up to row bottom, breaking up only
+    #   the raw lines (or parts of them) in that range
+    def lines(self, cols, top, bottom):
+        starts, _ = self.layout(cols)
+        lines = []
+        # raw line containing top row
+        i = bisect.bisect_right(starts, top) - 1
+        row = top
+        while row < bottom and i < len(self.raw_lines):
+            line = self.raw_lines[i]
+            # rows of this raw line that are wanted
+            first = row - starts[i]
+            last = min(bottom, starts[i+1]) - starts[i]
+            if len(line) == 0: # special case for empty line
+                lines.append('')
+            else:
+                lines += [line[x*cols:(x+1)*cols] for x in range(first, last)]
+            row = starts[i] + last
+            i += 1
+        return lines
@@ -0,0 +1,148 @@
+############################################################################
+#
+#   Placement.py
+#       strategies for placing new windows on screen, for
+#       WindowStack.recommend
+#
+############################################################################
+
+import numpy as np
+
+# each strategy takes a WindowStack and rows, cols dimensions for a new
+#   window, and returns [y, x] upper-left coordinates for it
+
+# cumulative sums of a over rows and columns, padded with a row and column
+#   of zeros, so the sum of a[y:y+rows, x:x+cols] for every y, x at once is
+#   sums[rows:, cols:] - sums[:-rows, cols:] - sums[rows:, :-cols]
+#       + sums[:-rows, :-cols]
+def integral(a):
+    sums = np.zeros((a.shape[0]+1, a.shape[1]+1), dtype=np.int64)
+    a.cumsum(axis=0, out=sums[1:,1:]).cumsum(axis=1, out=sums[1:,1:])
+    return sums
+
+def window_sums(sums, rows, cols):
+    return (sums[rows:,cols:] - sums[:-rows,cols:]
+            - sums[rows:,:-cols] + sums[:-rows,:-cols])
+
+# place where the new window would cover the least of the windows already
+#   there, weighing each window's density map against the new window's
+# that is, minimize over y, x the sum over the window of
+#   density[i,j] * dmap[y+i,x+j],  with density[i,j] = a - i - j
+#   (see WindowStack.initialize_densities), which works out to
+#   (a + y + x) * S0 - SY - SX, where S0, SY and SX are sums over the window
+#   of dmap, p * dmap and q * dmap at screen coordinates p, q
+# ties go to the rightmost, then lowest, position
+def least_overlap(stack, rows, cols):
+    dmap = stack.dmap
+    scr_rows, scr_cols = dmap.shape
+    if rows > scr_rows or cols > scr_cols or rows < 1 or cols < 1:
+        return [0,0]
+    a = stack.window_density[0,0]
+    p = np.arange(scr_rows, dtype=np.int64)[:,None]
+    q = np.arange(scr_cols, dtype=np.int64)[None,:]
+    S0 = window_sums(integral(dmap), rows, cols)
+    SY = window_sums(integral(dmap * p), rows, cols)
+    SX = window_sums(integral(dmap * q), rows, cols)
+    y = np.arange(S0.shape[0], dtype=np.int64)[:,None]
+    x = np.arange(S0.shape[1], dtype=np.int64)[None,:]
+    score = (a + y + x) * S0 - SY - SX
+    # last minimum going column by column, i.e. first going backwards
+    flat = score.T[::-1,::-1].argmin()
+    x, y = divmod(score.size - 1 - flat, score.shape[0])
+    return [int(y), int(x)]
+
+# each new window a step down and right of the top one, back to the corner
+#   when it would go off screen
+def cascade(stack, rows, cols):
+    scr_rows, scr_cols = stack.dmap.shape
+    if not stack.wins:
+        return [0,0]
+    y, x = stack.wins[-1].getbegyx()
+    y, x = y + 1, x + 2
+    if y + rows > scr_rows or x + cols > scr_cols:
+        return [0,0]
+    return [y, x]
+
+# place on a grid of window-sized tiles, in the first (going across then
+#   down) of those covering the least of the windows already there
+def tile(stack, rows, cols):
+    dmap = stack.dmap
+    scr_rows, scr_cols = dmap.shape
+    if rows > scr_rows or cols > scr_cols or rows < 1 or cols < 1:
+        return [0,0]
+    S0 = window_sums(integral(dmap), rows, cols)
+    # tiles flush against the top left, plus ones flush against the bottom
+    #   and right edges to use the leftover space
+    ys = sorted(set(range(0, scr_rows - rows + 1, rows)) | {scr_rows - rows})
+    xs = sorted(set(range(0, scr_cols - cols + 1, cols)) | {scr_cols - cols})
+    covered = S0[np.ix_(ys, xs)]
+    i, j = divmod(int(covered.argmin()), len(xs))
+    return [ys[i], xs[j]]
+
+strategies = {
+        'least_overlap': least_overlap,
+        'cascade': cascade,
+        'tile': tile,
+        }
+
+# benchmark strategies across terminal sizes, with a few windows open
+if __name__ == '__main__':
+    import time
+    import random
+
+    # enough of a screen and windows for WindowStack, without curses
+    class Screen:
+        def __init__(self, rows, cols):
+            self.rows, self.cols = rows, cols
+        def getmaxyx(self):
+            return self.rows, self.cols
+
+    class Window(Screen):
+        def __init__(self, rows, cols, y, x):
+            self.rows, self.cols, self.y, self.x = rows, cols, y, x
+        def getbegyx(self):
+            return self.y, self.x
+
+    # the double loop recommend used to be, for checking answers
+    def brute_force(stack, rows, cols):
+        density = stack.window_density[:rows, :cols]
+        scr_rows, scr_cols = stack.dmap.shape
+        candidate = [0,0]
+        for x in range(scr_cols - cols + 1):
+            for y in range(scr_rows - rows + 1):
+                score = np.multiply(density,
+                        stack.dmap[y:y+rows,x:x+cols]).sum()
+                if x == y == 0 or score <= candidate_score:
+                    candidate_score = score
+                    candidate = [y,x]
+        return candidate
+
+    from WindowStack import WindowStack
+
+    random.seed(0)
+    for scr_rows, scr_cols in [(24, 80), (50, 160), (100, 300), (200, 600)]:
+        stack = WindowStack(Screen(scr_rows, scr_cols))
+        rows, cols = min(40, scr_rows-1), min(80, scr_cols//2)
+        # open a few windows of random sizes in random places, without
+        #   drawing anything
+        for _ in range(4):
+            h, w = random.randint(1, rows), random.randint(1, cols)
+            y = random.randint(0, scr_rows - 1 - h)
+            x = random.randint(0, scr_cols - w)
+            window = Window(h, w, y, x)
+            stack.wins.append(window)
+            stack.dmap[y:y+h, x:x+w] += stack.window_density[:h,:w]
+        line = f'{scr_rows:>4}x{scr_cols:<4}'
+        for name, strategy in strategies.items():
+            start = time.perf_counter()
+            for _ in range(10):
+                strategy(stack, rows, cols)
+            elapsed = (time.perf_counter() - start) / 10
+            line += f'  {name} {elapsed*1000:8.3f}ms'
+        if scr_rows * scr_cols <= 100 * 300:
+            start = time.perf_counter()
+            answer = brute_force(stack, rows, cols)
+            elapsed = time.perf_counter() - start
+            assert answer == least_overlap(stack, rows, cols)
+            line += f'  brute force {elapsed*1000:8.3f}ms (same answer)'
+        print(line)
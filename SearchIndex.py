@@ -0,0 +1,301 @@
+############################################################################
+#
+#   SearchIndex.py
+#       persistent inverted full-text index for searching zettel
+#
+############################################################################
+
+import re
+import threading
+import config
+import utils
+
+# bump when the on-disk format changes, old indexes get rebuilt
+VERSION = 2
+
+# terms are maximal runs of word characters in lowercased text
+term_re = re.compile(r'\w+')
+
+# a row in docs for each zettel indexed, and in postings for each term in
+#   each zettel, looked up by term to search and by ID to take it out again
+# terms is the vocabulary, to find terms containing a fragment of a search,
+#   only ever added to (a term no zettel has any more just finds nothing)
+#   except when update() finds zettel gone
+schema = '''
+    CREATE TABLE IF NOT EXISTS docs (
+        ID TEXT PRIMARY KEY,
+        mtime INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        title TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS postings (
+        term TEXT NOT NULL,
+        ID TEXT NOT NULL,
+        PRIMARY KEY (term, ID)) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS postings_ID ON postings (ID);
+    CREATE TABLE IF NOT EXISTS terms (
+        term TEXT PRIMARY KEY) WITHOUT ROWID;
+    '''
+
+# terms looked up in one query, well under SQLite's limit on parameters
+chunk_size = 500
+# zettel read and indexed at a time when indexing in bulk, see add_many
+batch_size = 1000
+
+# kept in a SQLite database (see utils.index_db), so opening it doesn't
+#   read the whole thing in, and changes are written as they're made
+class SearchIndex:
+    def __init__(self, filepath=None):
+        # where the index is saved, by default next to .stack_save
+        self.filepath = filepath or config.search_index
+        # held while searching or changing the index, searches may run in
+        #   a background thread (see SearchWorker), sharing the connection
+        self.lock = threading.RLock()
+        self.db = utils.index_db(self.filepath, VERSION, schema)
+
+    def rows(self, sql, args=()):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    # changes go into a transaction, left open until save()
+    def begin(self):
+        if not self.db.in_transaction:
+            self.db.execute('BEGIN')
+
+    # commit changes made since last time, O(number of changes)
+    def save(self):
+        with self.lock:
+            if self.db.in_transaction:
+                self.db.execute('COMMIT')
+
+    # bring index up to date with kasten, only rereading files whose
+    #   mtime or size changed since they were indexed
+    # returns IDs of zettel changed (or new) and of those gone
+    def update(self):
+        snapshot = utils.scan_kasten()
+        with self.lock:
+            docs = {ID: (mtime, size) for ID, mtime, size in
+                    self.rows('SELECT ID, mtime, size FROM docs')}
+            gone = [ID for ID in docs if ID not in snapshot]
+            for ID in gone:
+                self.remove(ID)
+            if gone:    # drop terms only they had from the vocabulary
+                self.db.execute('''DELETE FROM terms WHERE NOT EXISTS
+                        (SELECT 1 FROM postings
+                            WHERE postings.term = terms.term)''')
+            changed = [ID for ID, stat in snapshot.items()
+                    if docs.get(ID) != stat]
+            if len(changed) > len(docs):    # e.g. building from scratch
+                self.add_many(changed, snapshot)
+            else:
+                for ID, text in utils.read_zettel(changed).items():
+                    self.add(ID, text, *snapshot[ID])
+            self.save()
+            return changed, gone
+
+    def add(self, ID, text, mtime, size):
+        with self.lock:
+            self.remove(ID)
+            terms = self.insert(ID, text, mtime, size)
+            self.db.executemany(
+                    'INSERT INTO postings (term, ID) VALUES (?, ?)', terms)
+            self.db.executemany(
+                    'INSERT OR IGNORE INTO terms (term) VALUES (?)',
+                    ((term,) for term, _ in terms))
+
+    # put zettel in docs, return its postings (to go in postings)
+    def insert(self, ID, text, mtime, size):
+        # title is first line, with newline, same as f.readline()
+        newline = text.find('\n')
+        title = text if newline == -1 else text[:newline+1]
+        self.db.execute('''INSERT INTO docs (ID, mtime, size, title)
+                VALUES (?, ?, ?, ?)''', (ID, mtime, size, title))
+        return [(term, ID) for term in set(term_re.findall(text.lower()))]
+
+    # add zettel IDs (with stats in snapshot), many more than are indexed
+    #   already: postings go in sorted by term a batch at a time, and the
+    #   index by ID and the vocabulary are built once at the end, rather
+    #   than row by row
+    def add_many(self, IDs, snapshot):
+        with self.lock:
+            for ID in IDs:
+                self.remove(ID)
+            self.db.execute('DROP INDEX postings_ID')
+            for i in range(0, len(IDs), batch_size):
+                texts = utils.read_zettel(IDs[i:i+batch_size])
+                postings = []
+                for ID, text in texts.items():
+                    postings += self.insert(ID, text, *snapshot[ID])
+                postings.sort()
+                self.db.executemany(
+                        'INSERT INTO postings (term, ID) VALUES (?, ?)',
+                        postings)
+            self.db.execute('CREATE INDEX postings_ID ON postings (ID)')
+            self.db.execute('''INSERT OR IGNORE INTO terms (term)
+                    SELECT DISTINCT term FROM postings''')
+
+    def remove(self, ID):
+        with self.lock:
+            self.begin()
+            self.db.execute('DELETE FROM postings WHERE ID = ?', (ID,))
+            self.db.execute('DELETE FROM docs WHERE ID = ?', (ID,))
+
+    def title(self, ID):
+        rows = self.rows('SELECT title FROM docs WHERE ID = ?', (ID,))
+        if not rows:
+            raise KeyError(ID)
+        return rows[0][0]
+
+    # IDs of all zettel indexed, in the order they were
+    def IDs(self):
+        return [ID for (ID,) in
+                self.rows('SELECT ID FROM docs ORDER BY rowid')]
+
+    # terms in the vocabulary containing fragment
+    def vocabulary(self, fragment):
+        return [term for (term,) in self.rows(
+            'SELECT term FROM terms WHERE instr(term, ?)', (fragment,))]
+
+    # IDs of zettel out of within (a set) containing any of terms, looking
+    #   no further once it's all of them (common terms for a short fragment
+    #   soon are)
+    def containing(self, terms, within):
+        IDs = set()
+        for i in range(0, len(terms), chunk_size):
+            chunk = terms[i:i+chunk_size]
+            marks = ', '.join('?' * len(chunk))
+            IDs.update(ID for (ID,) in self.rows(
+                f'SELECT ID FROM postings WHERE term IN ({marks})', chunk))
+            if within <= IDs:
+                break
+        return IDs & within
+
+    # terms containing fragment
+    # terms is an optional dict of fragment -> matching terms from earlier
+    #   queries, any cached fragment inside this one narrows the vocabulary
+    def matching_terms(self, fragment, terms=None):
+        if terms is None:
+            return self.vocabulary(fragment)
+        if fragment not in terms:
+            for cached in sorted(terms, key=len, reverse=True):
+                if cached in fragment:
+                    terms[fragment] = [term for term in terms[cached]
+                            if fragment in term]
+                    break
+            else:
+                terms[fragment] = self.vocabulary(fragment)
+        return terms[fragment]
+
+    # IDs of zettel matching search text, same semantics as the old scan:
+    #   '/' searches titles, '#' searches IDs, otherwise full text
+    # within optionally restricts to (ordered) IDs known to be a superset
+    #   of the results, e.g. results for a prefix of this search
+    def query(self, search_text, within=None, terms=None):
+        with self.lock:
+            return list(self.iter_query(search_text, within, terms))
+
+    # generator version of query, yields IDs as they are found
+    # cancelled is an optional function, checked before each file read,
+    #   that returns True to stop early
+    # hold self.lock while iterating
+    def iter_query(self, search_text, within=None, terms=None,
+            cancelled=None):
+        if within is None:
+            within = self.IDs()
+        # if search starts with '/', only search titles
+        if search_text.startswith('/'):
+            search_text = search_text[1:].lower()
+            titles = dict(self.rows('SELECT ID, title FROM docs'))
+            return (ID for ID in within if ID in titles
+                    and search_text in titles[ID].lower())
+        # if search starts with '#', only search IDs
+        elif search_text.startswith('#'):
+            search_text = search_text[1:].lower()
+            indexed = set(self.IDs())
+            return (ID for ID in within
+                    if ID in indexed and search_text in ID.lower())
+        # by default search full text
+        return self.iter_search(search_text, within, terms, cancelled)
+
+    # IDs of zettel containing query, same semantics as a case-insensitive
+    #   substring search of the full text
+    def iter_search(self, search_text, within=None, terms=None,
+            cancelled=None):
+        if within is None:
+            within = self.IDs()
+        query = search_text.lower()
+        fragments = set(term_re.findall(query))
+        if not fragments:
+            # nothing to look up in the index (e.g. only punctuation)
+            indexed = set(self.IDs())
+            candidates = [ID for ID in within if ID in indexed]
+        else:
+            matched = set(within)
+            # longest fragments first, they tend to narrow the most
+            for fragment in sorted(fragments, key=len, reverse=True):
+                matched = self.containing(
+                        self.matching_terms(fragment, terms), matched)
+                if not matched:
+                    return
+            # keep a consistent order, same as within
+            candidates = [ID for ID in within if ID in matched]
+        # a query made of a single run of word characters is found in the
+        #   text iff it is found in one of its terms, so we're done
+        # otherwise the index only narrows it down, check the actual text
+        if query == '' or fragments == {query}:
+            yield from candidates
+            return
+        for ID in candidates:
+            if cancelled and cancelled():
+                return
+            try:
+                text = utils.read_text(ID)
+            except (OSError, UnicodeDecodeError):
+                continue
+            if query in text.lower():
+                yield ID
+
+# one search-as-you-type session, e.g. from '/' to ENTER or ESC
+# every search result is a subset of the results for any prefix of it, so
+#   typing more narrows the last results instead of starting over, and
+#   backspace goes back to results kept from earlier in the session
+class SearchSession:
+    def __init__(self, index, max_results=32):
+        self.index = index
+        # search text -> list of IDs, most recent last
+        self.results = {}
+        # number of result lists to keep
+        self.max_results = max_results
+        # fragment -> terms containing it, shared by the session's queries
+        self.terms = {}
+
+    def search(self, search_text):
+        with self.index.lock:
+            return list(self.iter_search(search_text))
+
+    # generator version of search, yields IDs as they are found and only
+    #   keeps the results if it runs to the end
+    # hold self.index.lock while iterating
+    def iter_search(self, search_text, cancelled=None):
+        if search_text in self.results:
+            # keep it as most recent
+            IDs = self.results.pop(search_text)
+            self.results[search_text] = IDs
+            yield from IDs
+            return
+        else:
+            # narrow down from the longest prefix we have results for
+            within = None
+            prefixes = [prev for prev in self.results
+                    if search_text.startswith(prev)]
+            if prefixes:
+                within = self.results[max(prefixes, key=len)]
+            IDs = []
+            for ID in self.index.iter_query(search_text, within, self.terms,
+                    cancelled):
+                IDs.append(ID)
+                yield ID
+            if cancelled and cancelled():
+                return  # might be incomplete, don't keep it
+        self.results[search_text] = IDs
+        if len(self.results) > self.max_results:
+            del self.results[next(iter(self.results))]
@@ -0,0 +1,88 @@
+############################################################################
+#
+#   SearchWorker.py
+#       background thread for running searches without blocking keys
+#
+############################################################################
+
+import threading
+import utils
+
+class SearchWorker:
+    def __init__(self, batch=64):
+        # guards everything below, shared with the worker thread
+        self.lock = threading.Lock()
+        # wakes the worker thread when there's a new request
+        self.wake = threading.Condition(self.lock)
+        # pending request, (generation, session, search text) or None
+        self.request = None
+        # bumped by every new request or cancel, so the worker can tell
+        #   when the search it's running is stale
+        self.generation = 0
+        # results found so far for the current generation, None once it's
+        #   cancelled so nobody mistakes that for a search finding nothing
+        self.results = None
+        # flag for current generation finished (or nothing to do)
+        self.done = True
+        # number of results to collect before handing them over
+        self.batch = batch
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # start a search in a SearchSession, cancelling any search in flight
+    def submit(self, session, search_text):
+        with self.lock:
+            self.generation += 1
+            self.request = (self.generation, session, search_text)
+            self.results = []
+            self.done = False
+            self.wake.notify()
+
+    def cancel(self):
+        with self.lock:
+            self.generation += 1
+            self.request = None
+            self.results = None
+            self.done = True
+
+    # results so far for the latest request (None if it was cancelled, or
+    #   there wasn't one), and whether it's finished
+    def poll(self):
+        with self.lock:
+            if self.results is None:
+                return None, True
+            return list(self.results), self.done
+
+    def run(self):
+        while True:
+            with self.lock:
+                while self.request is None:
+                    self.wake.wait()
+                generation, session, search_text = self.request
+                self.request = None
+            cancelled = lambda: self.generation != generation
+            batch = []
+            try:
+                with session.index.lock:
+                    for ID in session.iter_search(search_text, cancelled):
+                        batch.append(ID)
+                        if len(batch) >= self.batch:
+                            if not self.hand_over(generation, batch):
+                                break
+                            batch = []
+                    else:
+                        self.hand_over(generation, batch, done=True)
+            except Exception as e:
+                # don't let one bad search take down the thread
+                utils.debugger(f'search error: {e}')
+                self.hand_over(generation, batch, done=True)
+
+    # add a batch of results, unless a newer request came in
+    def hand_over(self, generation, batch, done=False):
+        with self.lock:
+            if generation != self.generation:
+                return False
+            self.results += batch
+            self.done = done
+            return True
@@ -27,6 +27,8 @@ class StatusBar:
         self.searching = False
         # flag for command in progress
         self.command_mode = False
+        # indicator for background work, shown at right end of bar
+        self.busy = ''
 
         self.refresh()
 
@@ -50,8 +52,10 @@ class StatusBar:
         curses.curs_set(0) # hide cursor
         # pad with spaces to light up whole bar
         display = text + ' '*self.cols
+        if self.busy:
+            display = display[:self.cols-len(self.busy)-1] + self.busy
         self.win.insstr( 0,0, display, self.attr )
-        self.win.refresh()
+        self.win.noutrefresh() # to screen on the next curses.doupdate()
 
     def preview_ID(self, ID):
         if ID: # may be None
@@ -59,6 +63,12 @@ class StatusBar:
             text = ID.ljust(9) + title
             self.refresh(text)
 
+    # set (or clear, with '') indicator for background work
+    def set_busy(self, busy):
+        if busy != self.busy:
+            self.busy = busy
+            self.refresh()
+
     def set(self, text):
         self.text = text
         self.refresh()
@@ -95,6 +105,7 @@ class StatusBar:
                 directed = False
                 self.text = 'protographing ...'
             self.refresh()
+            curses.doupdate() # show it while we wait
             try:
                 utils.protograph(directed)
                 self.text = ''
@@ -0,0 +1,456 @@
+############################################################################
+#
+#   Storage.py
+#       storage backends for the kasten: a directory with one file per
+#       zettel, or a single SQLite database
+#
+############################################################################
+
+import os
+import re
+import time
+import mmap
+import locale
+import sqlite3
+import threading
+import config
+
+# files at least this big are memory-mapped rather than read
+mmap_size = 1 << 20
+
+# a directory with one file per zettel, named by ID
+# optionally sharded, with each zettel in a subdirectory named by the YYMM
+#   at the start of its ID, to keep directories small for huge kastens
+# zettel are found in either layout, so a kasten can be used while it's
+#   (or before it's) migrated from one to the other, see migrate()
+class DirectoryStorage:
+    def __init__(self, directory=None, sharded=None):
+        self.directory = directory or config.kasten_dir
+        if sharded is None:
+            sharded = config.kasten_sharded
+        self.sharded = sharded
+
+    # where a zettel goes in the flat and sharded layouts
+    def flat_path(self, ID):
+        return self.directory + ID
+
+    def shard_path(self, ID):
+        return self.directory + ID[:4] + '/' + ID
+
+    # where a zettel goes in the current layout
+    def home(self, ID):
+        return self.shard_path(ID) if self.sharded else self.flat_path(ID)
+
+    # where a zettel is: in the current layout, or if it isn't there (yet)
+    #   in the other one
+    def path(self, ID):
+        filepath = self.home(ID)
+        if os.path.exists(filepath):
+            return filepath
+        other = self.flat_path(ID) if self.sharded else self.shard_path(ID)
+        if os.path.exists(other):
+            return other
+        return filepath
+
+    # ID of zettel at path, inverse of self.path
+    def path_ID(self, path):
+        return os.path.basename(path)
+
+    # snapshot of kasten in one pass: dict of ID -> (mtime, size)
+    # includes zettel in subdirectories (shards) and at the top level, but
+    #   not dotfiles (e.g. a zettel being written, see write)
+    def scan(self):
+        snapshot = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_file():
+                    stat = entry.stat()
+                    snapshot[entry.name] = (stat.st_mtime_ns, stat.st_size)
+                elif entry.is_dir():
+                    snapshot.update(self.scan_shard(entry.path))
+        return snapshot
+
+    def scan_shard(self, directory):
+        snapshot = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_file():
+                    stat = entry.stat()
+                    snapshot[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    # subdirectories the kasten is sharded into (so far)
+    def shards(self):
+        with os.scandir(self.directory) as entries:
+            return [entry.path for entry in entries
+                    if entry.is_dir() and not entry.name.startswith('.')]
+
+    def IDs(self):
+        return list(self.scan())
+
+    # IDs starting with prefix, e.g. YYMMDD for a day's zettel
+    # only the matching shard (and top level) is listed, if sharded
+    def IDs_starting(self, prefix):
+        IDs = [name for name in os.listdir(self.directory)
+                if name.startswith(prefix)]
+        shard = self.directory + prefix[:4]
+        if len(prefix) >= 4 and os.path.isdir(shard):
+            IDs += [name for name in os.listdir(shard)
+                    if name.startswith(prefix)]
+        return IDs
+
+    def exists(self, ID):
+        return os.path.isfile(self.path(ID))
+
+    # (mtime, size) of zettel, raises FileNotFoundError if there isn't one
+    def stat(self, ID):
+        stat = os.stat(self.path(ID))
+        return stat.st_mtime_ns, stat.st_size
+
+    # full text of a zettel, same as open(...).read()
+    def read(self, ID):
+        filepath = self.path(ID)
+        if os.path.getsize(filepath) < mmap_size:
+            with open(filepath, 'r') as f:
+                return f.read()
+        with open(filepath, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                text = m[:].decode(locale.getpreferredencoding(False))
+        # universal newlines, as in text mode
+        return text.replace('\r\n', '\n').replace('\r', '\n')
+
+    # zettel memory-mapped read-only, for editing big ones (see FileLines)
+    # stays valid after the zettel is saved, as write() replaces the file
+    def map(self, ID):
+        with open(self.path(ID), 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # first line (with newline), reading at most limit characters
+    def read_title(self, ID, limit=-1):
+        with open(self.path(ID), 'r') as f:
+            return f.readline(limit)
+
+    # write to a temporary dotfile next to the zettel and move it into
+    #   place, so the zettel is never left half written (by a crash, or for a
+    #   sync to pick up), then make sure it's all on disk
+    def write(self, ID, text):
+        filepath = self.path(ID)
+        directory, name = os.path.split(filepath)
+        temp = os.path.join(directory, '.' + name + '.tmp')
+        try:
+            with open(temp, 'w') as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            try:    # keep permissions of the zettel it replaces
+                os.chmod(temp, os.stat(filepath).st_mode & 0o7777)
+            except FileNotFoundError:
+                pass
+            os.replace(temp, filepath)
+        except BaseException:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            raise
+        # and the rename, which is in the directory
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    # create empty zettel, raising FileExistsError if it already exists
+    def create(self, ID):
+        filepath = self.path(ID)
+        if filepath != self.home(ID):   # exists in the other layout
+            raise FileExistsError(f'zettel {ID} already exists')
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'x') as f:
+            pass
+
+    def delete(self, ID):
+        os.remove(self.path(ID))
+
+    # move zettel into the current layout (flat or sharded), return the
+    #   number of zettel moved
+    def migrate(self):
+        moved = 0
+        for ID in self.scan():
+            filepath, home = self.path(ID), self.home(ID)
+            if filepath == home:
+                continue
+            os.makedirs(os.path.dirname(home), exist_ok=True)
+            os.rename(filepath, home)
+            moved += 1
+        if not self.sharded:
+            # clean up shards left empty
+            for shard in self.shards():
+                if not os.listdir(shard):
+                    os.rmdir(shard)
+        return moved
+
+    # indexes for searching and backlinks, kept alongside the directory
+    def search_index(self):
+        from SearchIndex import SearchIndex
+        return SearchIndex()
+
+    def link_graph(self):
+        from LinkGraph import LinkGraph
+        return LinkGraph()
+
+# regex to match links in notes
+link_re = re.compile(r'#(\d+[a-z]+)')
+
+# a single SQLite database, with tables for zettel (text and title) and
+#   links, and an FTS5 index for full-text search
+class SQLiteStorage:
+    def __init__(self, filepath=None):
+        self.filepath = filepath or config.kasten_db
+        # not a directory of files, so nothing to watch or memory-map
+        self.directory = None
+        # one connection, shared between threads (searches run in the
+        #   background), so serialize access to it
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(self.filepath, check_same_thread=False,
+                isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS zettel (
+                ID TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                text TEXT NOT NULL,
+                mtime INTEGER NOT NULL,
+                size INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS links (
+                src TEXT NOT NULL,
+                dst TEXT NOT NULL,
+                PRIMARY KEY (src, dst)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS links_dst ON links (dst, src);
+            ''')
+        # trigram tokenizer lets FTS5 answer substring (LIKE) queries
+        # rows share rowids with the zettel table
+        self.db.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS zettel_fts
+            USING fts5(text, tokenize='trigram')''')
+
+    def query(self, sql, args=()):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    # kept so code written for files can still find a zettel by "path"
+    def path(self, ID):
+        return config.kasten_dir + ID
+
+    def path_ID(self, path):
+        return os.path.basename(path)
+
+    def scan(self):
+        return {ID: (mtime, size) for ID, mtime, size in
+                self.query('SELECT ID, mtime, size FROM zettel')}
+
+    def IDs(self):
+        return [ID for (ID,) in self.query('SELECT ID FROM zettel')]
+
+    # IDs starting with prefix, using the primary key index
+    def IDs_starting(self, prefix):
+        return [ID for (ID,) in self.query(
+            'SELECT ID FROM zettel WHERE ID >= ? AND ID < ?',
+            (prefix, prefix + '\U0010ffff'))]
+
+    def exists(self, ID):
+        return bool(self.query('SELECT 1 FROM zettel WHERE ID = ?', (ID,)))
+
+    def row(self, sql, ID):
+        rows = self.query(sql, (ID,))
+        if not rows:
+            raise FileNotFoundError(f'no zettel {ID} in {self.filepath}')
+        return rows[0]
+
+    def stat(self, ID):
+        return self.row('SELECT mtime, size FROM zettel WHERE ID = ?', ID)
+
+    def read(self, ID):
+        return self.row('SELECT text FROM zettel WHERE ID = ?', ID)[0]
+
+    def read_title(self, ID, limit=-1):
+        title = self.row('SELECT title FROM zettel WHERE ID = ?', ID)[0]
+        return title if limit < 0 else title[:limit]
+
+    def write(self, ID, text):
+        newline = text.find('\n')
+        title = text if newline == -1 else text[:newline+1]
+        links = set(link_re.findall(text))
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                self.db.execute('''
+                    INSERT INTO zettel (ID, title, text, mtime, size)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (ID) DO UPDATE SET title = excluded.title,
+                        text = excluded.text, mtime = excluded.mtime,
+                        size = excluded.size''',
+                    (ID, title, text, time.time_ns(), len(text.encode())))
+                self.db.execute('DELETE FROM links WHERE src = ?', (ID,))
+                self.db.executemany(
+                        'INSERT INTO links (src, dst) VALUES (?, ?)',
+                        [(ID, link_ID) for link_ID in links])
+                (rowid,), = self.db.execute(
+                        'SELECT rowid FROM zettel WHERE ID = ?', (ID,))
+                self.db.execute('DELETE FROM zettel_fts WHERE rowid = ?',
+                        (rowid,))
+                self.db.execute(
+                        'INSERT INTO zettel_fts (rowid, text) VALUES (?, ?)',
+                        (rowid, text))
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def create(self, ID):
+        with self.lock:
+            if self.exists(ID):
+                raise FileExistsError(f'zettel {ID} already exists')
+            self.write(ID, '')
+
+    def delete(self, ID):
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                self.db.execute('''DELETE FROM zettel_fts WHERE rowid =
+                        (SELECT rowid FROM zettel WHERE ID = ?)''', (ID,))
+                self.db.execute('DELETE FROM zettel WHERE ID = ?', (ID,))
+                self.db.execute('DELETE FROM links WHERE src = ?', (ID,))
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+
+    # copy zettel from kasten_dir into the database, those it doesn't have
+    #   yet or has an older copy of, return the number of zettel copied
+    # the directory is left as it is, so it can be switched back to
+    def migrate(self, directory=None):
+        source = DirectoryStorage(directory)
+        if not os.path.isdir(source.directory):
+            return 0
+        have = self.scan()
+        copied = 0
+        for ID, (mtime, size) in source.scan().items():
+            if ID in have and have[ID][0] >= mtime:
+                continue
+            try:
+                self.write(ID, source.read(ID))
+            except FileNotFoundError:
+                continue # deleted since the scan
+            copied += 1
+        return copied
+
+    # the database keeps its own indexes up to date on every write
+    def search_index(self):
+        return FTSIndex(self)
+
+    def link_graph(self):
+        return SQLLinks(self)
+
+# escape LIKE wildcards, for use with ESCAPE '\'
+def like_pattern(text):
+    text = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return '%' + text + '%'
+
+# same interface as SearchIndex, answered by SQLite queries
+# note LIKE is only case-insensitive for ASCII letters
+class FTSIndex:
+    def __init__(self, storage):
+        self.storage = storage
+        self.lock = storage.lock
+
+    # nothing to do, the database indexes zettel as they are written
+    def update(self):
+        return [], []
+
+    def add(self, ID, text, mtime, size):
+        pass
+
+    def remove(self, ID):
+        pass
+
+    def save(self):
+        pass
+
+    def title(self, ID):
+        return self.storage.read_title(ID)
+
+    def query(self, search_text, within=None, terms=None):
+        with self.lock:
+            return list(self.iter_query(search_text, within, terms))
+
+    def iter_query(self, search_text, within=None, terms=None,
+            cancelled=None):
+        # if search starts with '/', only search titles
+        if search_text.startswith('/'):
+            sql = "SELECT ID FROM zettel WHERE title LIKE ? ESCAPE '\\'"
+            search_text = search_text[1:]
+        # if search starts with '#', only search IDs
+        elif search_text.startswith('#'):
+            sql = "SELECT ID FROM zettel WHERE ID LIKE ? ESCAPE '\\'"
+            search_text = search_text[1:]
+        # by default search full text
+        else:
+            sql = ("SELECT zettel.ID FROM zettel_fts JOIN zettel"
+                    " ON zettel.rowid = zettel_fts.rowid"
+                    " WHERE zettel_fts.text LIKE ? ESCAPE '\\'"
+                    " ORDER BY zettel.rowid")
+        IDs = [ID for (ID,) in self.storage.query(sql,
+                (like_pattern(search_text),))]
+        if within is None:
+            return iter(IDs)
+        # keep the order of within
+        IDs = set(IDs)
+        return (ID for ID in within if ID in IDs)
+
+# same interface as LinkGraph, answered by SQLite queries
+class SQLLinks:
+    def __init__(self, storage):
+        self.storage = storage
+
+    # nothing to do, the database keeps links as zettel are written
+    def update(self):
+        return [], []
+
+    def set_links(self, ID, links, stat):
+        pass
+
+    def remove(self, ID):
+        pass
+
+    def save(self):
+        pass
+
+    # links are always read as zettel are written, so as of their stat now
+    def stat(self, ID):
+        try:
+            return self.storage.stat(ID)
+        except FileNotFoundError:
+            return None
+
+    def links(self, ID):
+        return [dst for (dst,) in self.storage.query(
+            'SELECT dst FROM links WHERE src = ?', (ID,))]
+
+    # IDs of zettel that link to ID but aren't linked to from ID
+    def backlinks(self, ID):
+        import utils
+        return sorted((src for (src,) in self.storage.query('''
+                SELECT src FROM links WHERE dst = ?1
+                AND src NOT IN (SELECT dst FROM links WHERE src = ?1)''',
+                (ID,))), key=utils.ID_sort)
+
+    # IDs of all zettel that link to ID
+    def linking_to(self, ID):
+        import utils
+        return sorted((src for (src,) in self.storage.query(
+            'SELECT src FROM links WHERE dst = ?', (ID,))), key=utils.ID_sort)
@@ -0,0 +1,227 @@
+############################################################################
+#
+#   Syncer.py
+#       background thread for syncing kasten with remote via rclone,
+#       coalescing requests and limiting how often it runs
+#
+############################################################################
+
+import subprocess
+import threading
+import time
+import config
+
+class Syncer:
+    def __init__(self, interval=None):
+        # minimum seconds between the starts of two syncs
+        if interval is None:
+            interval = config.sync_interval
+        self.interval = interval
+        # guards everything below, shared with the sync thread
+        self.lock = threading.Lock()
+        # wakes the sync thread (new request), or whoever waits on a sync
+        self.wake = threading.Condition(self.lock)
+        # flag for sync requested since the last one started
+        self.pending = False
+        # flag for sync in progress
+        self.running = False
+        # flag to hold off the sync thread, while flushing
+        self.stopped = False
+        # time.monotonic() when the last sync started
+        self.last_run = None
+        # exception from the last sync, until someone takes it
+        self.error = None
+        # flag for last sync failed, so it gets retried on flush
+        self.failed = False
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def command(self):
+        # leaving out zettel halfway through being written, see
+        #   DirectoryStorage.write
+        return ['rclone', 'bisync', '--max-delete', '0',
+                '--exclude', '.*.tmp',
+                config.kasten_dir, config.kasten_sync]
+
+    # run one sync, raising CalledProcessError if it fails
+    def sync(self):
+        completed = subprocess.run(self.command(),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        completed.check_returncode()
+
+    # ask for a sync soon, any number of requests before it starts are
+    #   covered by one sync
+    def request(self):
+        with self.lock:
+            self.pending = True
+            self.wake.notify_all()
+
+    # exception from last sync if it failed, only returned once
+    def take_error(self):
+        with self.lock:
+            error, self.error = self.error, None
+            return error
+
+    def run(self):
+        while True:
+            with self.lock:
+                # wait until there's a request and we're allowed to run
+                while True:
+                    if not self.pending or self.stopped:
+                        self.wake.wait()
+                        continue
+                    delay = 0
+                    if self.last_run is not None:
+                        next_run = self.last_run + self.interval
+                        delay = next_run - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.wake.wait(delay)
+                self.pending = False
+                self.running = True
+                self.last_run = time.monotonic()
+            try:
+                self.sync()
+                error = None
+            except (subprocess.CalledProcessError, OSError) as e:
+                error = e
+            with self.lock:
+                self.running = False
+                self.error = error
+                self.failed = error is not None
+                self.wake.notify_all()
+
+    # wait for any sync in progress, then sync right away if there are
+    #   requests left over or the last sync failed, e.g. before quitting
+    # raises if that sync fails
+    def flush(self):
+        with self.lock:
+            self.stopped = True
+            while self.running:
+                self.wake.wait()
+            needed = self.pending or self.failed
+            self.pending = False
+        try:
+            if needed:
+                self.sync()
+            with self.lock:
+                self.failed = False
+        except (subprocess.CalledProcessError, OSError):
+            # leave it for the sync thread to try again
+            with self.lock:
+                self.pending = True
+            raise
+        finally:
+            with self.lock:
+                self.stopped = False
+                self.wake.notify_all()
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import shutil
+    import tempfile
+
+    # stand-in for rclone, copying one local directory to another, and
+    #   failing while there's a file named fail next to them
+    copy = '''import sys, os, shutil
+src, dst, fail = sys.argv[1:]
+if os.path.exists(fail):
+    sys.exit(1)
+shutil.copytree(src, dst, dirs_exist_ok=True)
+'''
+
+    class LocalSyncer(Syncer):
+        def __init__(self, tmp, interval):
+            self.tmp = tmp
+            # time.monotonic() at the start of each sync
+            self.starts = []
+            super().__init__(interval)
+        def command(self):
+            return [sys.executable, '-c', copy,
+                    os.path.join(self.tmp, 'kasten'),
+                    os.path.join(self.tmp, 'remote'),
+                    os.path.join(self.tmp, 'fail')]
+        def sync(self):
+            self.starts.append(time.monotonic())
+            super().sync()
+
+    def write(tmp, name, text):
+        with open(os.path.join(tmp, 'kasten', name), 'w') as f:
+            f.write(text)
+
+    def remote(tmp, name):
+        try:
+            with open(os.path.join(tmp, 'remote', name)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    # wait for the sync thread to have nothing left to do
+    def settle(syncer):
+        while True:
+            with syncer.lock:
+                if not (syncer.pending or syncer.running):
+                    return
+            time.sleep(0.01)
+
+    interval = 0.5
+    tmp = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(tmp, 'kasten'))
+        syncer = LocalSyncer(tmp, interval)
+
+        # a burst of requests is covered by a sync right away and one more
+        #   after the interval, which sees the last write
+        for i in range(40):
+            write(tmp, '230101a', f'version {i}')
+            syncer.request()
+            time.sleep(0.005)
+        settle(syncer)
+        assert len(syncer.starts) <= 3, syncer.starts
+        assert remote(tmp, '230101a') == 'version 39'
+        assert syncer.take_error() is None
+        print(f'coalescing: 40 requests, {len(syncer.starts)} syncs')
+
+        # syncs start no closer together than the interval
+        gaps = [b - a for a, b in zip(syncer.starts, syncer.starts[1:])]
+        assert all(gap >= interval for gap in gaps), gaps
+        print(f'rate limit: gaps {[round(gap, 2) for gap in gaps]}s')
+
+        # a failed sync reports its error once, and flush retries it
+        open(os.path.join(tmp, 'fail'), 'w').close()
+        write(tmp, '230101b', 'lost?')
+        syncer.request()
+        settle(syncer)
+        assert isinstance(syncer.take_error(),
+                subprocess.CalledProcessError)
+        assert syncer.take_error() is None
+        assert syncer.failed and remote(tmp, '230101b') is None
+        # flush failing too raises, and leaves a request for the thread
+        try:
+            syncer.flush()
+            assert False, 'flush should have failed'
+        except subprocess.CalledProcessError:
+            pass
+        with syncer.lock:
+            assert syncer.pending
+            syncer.pending = False # leave the retry to flush below
+        os.remove(os.path.join(tmp, 'fail'))
+        syncer.flush()
+        assert not syncer.failed and remote(tmp, '230101b') == 'lost?'
+        print('retry: failed sync reported once, flush synced it')
+
+        # flush on quit syncs a request right away, without waiting for
+        #   the interval to run out
+        syncer.flush() # nothing to do, shouldn't sync
+        runs = len(syncer.starts)
+        write(tmp, '230101c', 'last words')
+        syncer.request()
+        start = time.monotonic()
+        syncer.flush()
+        assert remote(tmp, '230101c') == 'last words'
+        assert len(syncer.starts) == runs + 1
+        print(f'flush: synced in {time.monotonic() - start:.2f}s')
+    finally:
+        shutil.rmtree(tmp)
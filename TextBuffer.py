@@ -0,0 +1,181 @@
+############################################################################
+#
+#   TextBuffer.py
+#       lines of text for Editor, with a gap buffer on the line being edited
+#       so typing and backspacing don't rebuild it every time
+#
+############################################################################
+
+from FileLines import FileLines
+
+class TextBuffer:
+    def __init__(self, lines, layout=None, history=None, journal=None):
+        # lines of text (without trailing newlines), at least one, in a list
+        #   or, for a big file, FileLines
+        if isinstance(lines, FileLines):
+            self.lines = lines
+        else:
+            self.lines = list(lines) or ['']
+        # LineLayout to keep up to date with line lengths, if any
+        self.layout = layout
+        # UndoLog to record edits in, if any
+        self.history = history
+        # Journal to write edits to as they happen, if any
+        self.journal = journal
+        # line held in the gap buffer, its entry in self.lines is stale
+        self.gap_row = None
+        # characters before the gap, and after it (last first), so typing
+        #   and backspacing at the gap are appends and pops
+        self.left = []
+        self.right = []
+        # line in gap buffer as str, None until asked for after an edit
+        self.joined = None
+        # count of edits made, so a caller can tell cheaply whether anything
+        #   happened since it last looked
+        self.generation = 0
+
+    def __len__(self):
+        return len(self.lines)
+
+    # line i as str
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.lines)
+        if i != self.gap_row:
+            return self.lines[i]
+        if self.joined is None:
+            self.joined = ''.join(self.left) + ''.join(reversed(self.right))
+        return self.joined
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __repr__(self):
+        return repr(list(self.snapshot()))
+
+    # length of line i, without building it
+    def length(self, i):
+        if i == self.gap_row:
+            return len(self.left) + len(self.right)
+        return len(self.lines[i])
+
+    # all lines as a tuple, sharing the strs (only the pointers are copied)
+    def snapshot(self):
+        lines = list(self.lines)
+        if self.gap_row is not None:
+            lines[self.gap_row] = self[self.gap_row]
+        return tuple(lines)
+
+    # whole text, as saved
+    def text(self):
+        return '\n'.join(self.snapshot()) + '\n'
+
+    # put gap at col in line row, O(distance moved) within the same line,
+    #   O(length of line) to move to another
+    def focus(self, row, col):
+        if row != self.gap_row:
+            self.flush()
+            line = self.lines[row]
+            self.left = list(line[:col])
+            self.right = list(reversed(line[col:]))
+            self.gap_row = row
+            self.joined = line
+        elif col < len(self.left):
+            self.right.extend(reversed(self.left[col:]))
+            del self.left[col:]
+        elif col > len(self.left):
+            moved = col - len(self.left)
+            self.left.extend(reversed(self.right[-moved:]))
+            del self.right[-moved:]
+
+    # put line in gap buffer back in self.lines, before lines move around
+    def flush(self):
+        if self.gap_row is not None:
+            self.lines[self.gap_row] = self[self.gap_row]
+        self.gap_row = None
+        self.left = []
+        self.right = []
+        self.joined = None
+
+    # count edit, and record it (see UndoLog) for undo and in the journal,
+    #   if it changed anything
+    def record(self, kind, row, col, text):
+        if not text:
+            return
+        self.generation += 1
+        if self.history is not None:
+            self.history.record((kind, row, col, text))
+        if self.journal is not None:
+            self.journal.record((kind, row, col, text))
+
+    # let layout know lines i up to j are now those from i up to i + n
+    def changed(self, i, j, n):
+        if self.layout is None:
+            return
+        if j - i == n == 1:
+            self.layout.set(i, self.length(i))
+        else:
+            self.layout.splice(i, j, [self.length(k) for k in range(i, i+n)])
+
+    # insert text (maybe several lines) at col in line row
+    # returns row, col at the end of inserted text
+    def insert(self, row, col, text):
+        self.record('insert', row, col, text)
+        if '\n' not in text:    # within the line, at the gap
+            self.focus(row, col)
+            self.left.extend(text)
+            self.joined = None
+            self.changed(row, row+1, 1)
+            return row, col + len(text)
+        self.flush()
+        line = self.lines[row]
+        lines = text.split('\n')
+        end_col = len(lines[-1])
+        lines[0] = line[:col] + lines[0]
+        lines[-1] += line[col:]
+        self.lines[row:row+1] = lines
+        self.changed(row, row+1, len(lines))
+        return row + len(lines) - 1, end_col
+
+    # delete text from col in line row up to end_col in line end_row
+    # returns deleted text
+    def delete(self, row, col, end_row, end_col):
+        if row == end_row:  # within the line, at the gap
+            self.focus(row, end_col)
+            deleted = ''.join(self.left[col:])
+            del self.left[col:]
+            self.joined = None
+            self.changed(row, row+1, 1)
+            self.record('delete', row, col, deleted)
+            return deleted
+        self.flush()
+        first = self.lines[row]
+        last = self.lines[end_row]
+        deleted = '\n'.join([first[col:]] + self.lines[row+1:end_row]
+                + [last[:end_col]])
+        self.lines[row:end_row+1] = [first[:col] + last[end_col:]]
+        self.changed(row, end_row+1, 1)
+        self.record('delete', row, col, deleted)
+        return deleted
+
+    # insert whole lines before line i
+    def insert_lines(self, i, lines):
+        self.record('insert_lines', i, 0, tuple(lines))
+        self.flush()
+        self.lines[i:i] = lines
+        self.changed(i, i, len(lines))
+
+    # remove whole lines i up to j, leaving an empty line if that's all
+    # returns removed lines
+    def delete_lines(self, i, j):
+        self.flush()
+        removed = self.lines[i:j]
+        del self.lines[i:j]
+        if self.lines:
+            self.changed(i, j, 0)
+            self.record('delete_lines', i, 0, tuple(removed))
+        else:
+            self.lines.append('')
+            self.changed(i, j, 1)
+            self.record('delete_lines', i, 1, tuple(removed))
+        return removed
@@ -0,0 +1,162 @@
+############################################################################
+#
+#   UndoLog.py
+#       undo/redo for Editor, as a log of the edits made to its TextBuffer
+#       rather than copies of the text
+#
+############################################################################
+
+import config
+
+# edits are recorded as tuples (kind, row, col, text), kind is one of
+#   'insert'        text inserted at row, col
+#   'delete'        text deleted from row, col
+#   'insert_lines'  lines (a tuple) inserted before line row
+#   'delete_lines'  lines (a tuple) removed from line row on, col is 1 if
+#                   that left an empty line in place of the last of them
+# and grouped into steps, each undone or redone in one go
+
+# number of characters an edit keeps in memory
+def size(edit):
+    kind, row, col, text = edit
+    if kind in ('insert', 'delete'):
+        return len(text)
+    return sum(len(line) + 1 for line in text)
+
+class UndoLog:
+    def __init__(self, limit=None):
+        # characters of text to keep, oldest steps are dropped past this
+        self.limit = limit or config.undo_limit
+        # steps to undo and redo, each a list of edits, most recent last
+        self.undone = []
+        self.steps = []
+        # characters kept in both
+        self.size = 0
+        # flag for the next edit to start a new step, even if it could
+        #   join the last one
+        self.closed = True
+        # flag for edits being undone or redone, not to be recorded
+        self.applying = False
+        # text of the last edit while edits are joined to it, as a list of
+        #   chunks (last first, for a delete) and their length, put
+        #   together by settle(), so typing a long line doesn't copy it
+        #   over and over
+        self.run = None
+        self.run_length = 0
+
+    # record edit made to buffer, called by TextBuffer
+    def record(self, edit):
+        if self.applying:
+            return
+        # a new edit means nothing to redo
+        for step in self.undone:
+            self.size -= sum(size(e) for e in step)
+        self.undone = []
+        self.size += size(edit)
+        if self.closed or not self.steps or not self.join(edit):
+            self.settle()
+            self.steps.append([edit])
+        self.closed = False
+        # drop oldest steps over the limit, keeping at least the last one
+        while self.size > self.limit and len(self.steps) > 1:
+            self.size -= sum(size(e) for e in self.steps.pop(0))
+
+    # join edit to the last one if it carries on from it, i.e. typing or
+    #   backspacing along a line, return True if joined
+    def join(self, edit):
+        step = self.steps[-1]
+        kind, row, col, text = step[-1]
+        new_kind, new_row, new_col, new_text = edit
+        if kind != new_kind or row != new_row \
+                or '\n' in text or '\n' in new_text:
+            return False
+        length = len(text) if self.run is None else self.run_length
+        if kind == 'insert' and new_col == col + length:
+            pass
+        elif kind == 'delete' and new_col + len(new_text) == col:
+            step[-1] = (kind, row, new_col, text)
+        else:
+            return False
+        if self.run is None:
+            self.run = [text]
+            self.run_length = len(text)
+        self.run.append(new_text)
+        self.run_length += len(new_text)
+        return True
+
+    # put together text of the edits joined to the last one
+    def settle(self):
+        if self.run is None:
+            return
+        kind, row, col, text = self.steps[-1][-1]
+        if kind == 'delete':
+            self.run.reverse()
+        self.steps[-1][-1] = (kind, row, col, ''.join(self.run))
+        self.run = None
+
+    # start a new step with the next edit, e.g. after moving the cursor
+    def close(self):
+        self.settle()
+        self.closed = True
+
+    # undo last step on buffer, return cursor position (row, col) to go
+    #   back to, or None if nothing to undo
+    def undo(self, buffer):
+        if not self.steps:
+            return None
+        self.settle()
+        step = self.steps.pop()
+        self.undone.append(step)
+        self.closed = True
+        self.applying = True
+        try:
+            for edit in reversed(step):
+                cursor = self.apply(buffer, self.inverse(edit))
+        finally:
+            self.applying = False
+        return cursor
+
+    # redo last step undone, like undo
+    def redo(self, buffer):
+        if not self.undone:
+            return None
+        step = self.undone.pop()
+        self.steps.append(step)
+        self.closed = True
+        self.applying = True
+        try:
+            for edit in step:
+                cursor = self.apply(buffer, edit)
+        finally:
+            self.applying = False
+        return cursor
+
+    # edit that undoes edit
+    def inverse(self, edit):
+        kind, row, col, text = edit
+        inverses = {'insert': 'delete', 'delete': 'insert',
+                'insert_lines': 'delete_lines', 'delete_lines': 'insert_lines'}
+        return (inverses[kind], row, col, text)
+
+    # make edit to buffer, return cursor position after it
+    def apply(self, buffer, edit):
+        kind, row, col, text = edit
+        if kind == 'insert':
+            return buffer.insert(row, col, text)
+        if kind == 'delete':
+            # work out where deleted text ends
+            lines = text.split('\n')
+            if len(lines) == 1:
+                end_row, end_col = row, col + len(text)
+            else:
+                end_row, end_col = row + len(lines) - 1, len(lines[-1])
+            buffer.delete(row, col, end_row, end_col)
+            return row, col
+        if kind == 'insert_lines':
+            buffer.insert_lines(row, list(text))
+            if col: # take out the empty line left in their place
+                buffer.delete_lines(row + len(text), row + len(text) + 1)
+            return row, 0
+        # kind == 'delete_lines'
+        buffer.delete_lines(row, row + len(text))
+        return min(row, len(buffer) - 1), 0
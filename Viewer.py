@@ -6,9 +6,7 @@
 ############################################################################
 
 import curses
-import re
-import io
-from contextlib import redirect_stdout
+import bisect
 import sys
 import os
 import utils
@@ -27,7 +25,6 @@ class Viewer:
         # top line of text visible
         self.top = top
 
-        self.lines = [] # create variable initialized in self.load()
         self.links = [] # create variable initialized in self.load()
         self.load()
         self.refresh()
@@ -49,107 +46,69 @@ class Viewer:
                         + f'self.cols: {self.cols}\n'
                         + f'self.top: {self.top}\n',
                         file=f)
-                print(self.lines, file=f)
+                print(self.visible_lines(), file=f)
 
     def load(self):
-        # load text from file as a list of lines
-        with open(self.filepath, 'r') as f:
-            raw_lines = f.readlines()
-        raw_lines = [line.rstrip('\n') for line in raw_lines]
-
-        # if zettel has code, try to execute it and display results
-        code_start = -1
-        # look for first line of code, marked by shebang
-        for i in range(len(raw_lines)):
-            if raw_lines[i].startswith('#!'):
-                code_start = i
-                break
-        # if we found a shebang: grab code, execute, and replace
-        if code_start > -1:
-            try:
-                code = '\n'.join(raw_lines[code_start:])
-                with io.StringIO() as out, redirect_stdout(out):
-                    exec(code)
-                    output = out.getvalue()
-                raw_lines = raw_lines[:code_start] + output.splitlines()
-            except Exception as e:
-                # if there's an error, show code and error
-                raw_lines += str(e).splitlines()
-
-        # break raw lines into lines of window length
-        self.lines = []
-        line_lengths = [] # to translate between raw_lines and self.lines
-        for line in raw_lines:
-            if len(line) == 0: # special case for empty line
-                line_lengths.append(1)
-                self.lines.append('')
-            else:
-                line_lengths.append(-(len(line) // -self.cols)) # ceiling //
-                for x in range(0, len(line), self.cols):
-                    self.lines.append(line[x:x+self.cols])
-
-        # create list of zk links, hyperlinks, and file links
+        # parse zettel, or reuse the last parse if it hasn't changed
+        my_ID = self.filepath.split('/')[-1]
+        self.parsed = utils.parse_zettel(my_ID)
+        # lay out raw lines in lines of window length, with links
         #   each a dict of ID(/url/filepath), start coords, and label
-        ref = re.compile(r'#\d+[a-z]+')
-        hyperref = re.compile(r'https?://\S+')
-        fileref = re.compile(r'~/[-_a-zA-Z0-9/]+(\.|\*)[a-zA-Z]*')
-        self.links = []
-        for i, line in enumerate(raw_lines):
-            for link in ref.finditer(line):
-                row = sum(line_lengths[:i]) + (link.start() // self.cols)
-                col = link.start() % self.cols
-                self.links.append({
-                    'ID': link.group(),
-                    'row': row,
-                    'col': col
-                    })
-            for link in hyperref.finditer(line):
-                row = sum(line_lengths[:i]) + (link.start() // self.cols)
-                col = link.start() % self.cols
-                self.links.append({
-                    'ID': link.group(),
-                    'row': row,
-                    'col': col,
-                    'url': True
-                    })
-            for link in fileref.finditer(line):
-                row = sum(line_lengths[:i]) + (link.start() // self.cols)
-                col = link.start() % self.cols
-                self.links.append({
-                    'ID': link.group(),
-                    'row': row,
-                    'col': col,
-                    'file': True
-                    })
-        # sort links by position in text
-        self.links.sort(key=lambda l: [l['row'], l['col']])
+        # lines are only broken up when they're shown, see visible_lines()
+        starts, links = self.parsed.layout(self.cols)
+        self.text_rows = starts[-1] # rows of text, before backlinks
+        # copy, since the layout is shared and backlinks get added below
+        self.links = list(links)
 
         # search for backlinks
-        my_ID = self.filepath.split('/')[-1]
+        self.backlines = [] # lines listing backlinks, below the text
         backlinks = utils.list_backlinks(my_ID)
         if backlinks:
-            self.lines += ['','']
-            row = sum(line_lengths) + 1 # keep track of row for self.links
+            self.backlines += ['','']
+            row = self.text_rows + 1 # keep track of row for self.links
             for ID in backlinks:
                 row += 1
                 title = utils.get_title(ID)
                 # add to text and add to links
-                self.lines.append(f'    <- #{ID} {title}')
+                self.backlines.append(f'    <- #{ID} {title}')
                 self.links.append({
                     'ID': '#'+ID,
                     'row': row,
                     'col': 7
                     })
+        self.nrows = self.text_rows + len(self.backlines)
+        # rows of links, in order, to find those on screen by bisection
+        self.link_rows = [link['row'] for link in self.links]
+        # keep cursor and view inside the zettel, which may have shrunk
+        #   if it was reloaded after a change
+        self.link = min(self.link, len(self.links) - 1)
+        self.top = max(0, min(self.top, self.nrows - self.rows))
 
+    # lines of window length on screen, from self.top
+    def visible_lines(self):
+        bottom = min(self.top + self.rows, self.nrows)
+        lines = self.parsed.lines(self.cols, self.top,
+                min(bottom, self.text_rows))
+        lines += self.backlines[max(0, self.top - self.text_rows):
+                max(0, bottom - self.text_rows)]
+        return lines
+
+    # mark window to be drawn with the next frame, see WindowStack.render
     def refresh(self):
+        self.dirty = True
+
+    def render(self):
+        self.dirty = False
         self.win.erase()
 
-        # i = row in self.lines, j = row in window
-        for i in range(self.top, min(self.top+self.rows,len(self.lines))):
-            j = i - self.top
-            self.win.insstr( j,0, self.lines[i])
-        # underline links
-        for i, link in enumerate(self.links):
+        # j = row in window
+        for j, line in enumerate(self.visible_lines()):
+            self.win.insstr( j,0, line)
+        # underline links on screen (including one broken over from above)
+        first = bisect.bisect_left(self.link_rows, self.top - 1)
+        last = bisect.bisect_left(self.link_rows, self.top + self.rows)
+        for i in range(first, last):
+            link = self.links[i]
             # assume a link is broken over at most two lines
             breakpt = self.cols - link['col']
             if i == self.link: # highlight link under cursor
@@ -169,17 +128,18 @@ class Viewer:
         # hide cursor
         curses.curs_set(0)
 
-        self.win.refresh()
+        # to screen on the next curses.doupdate(), with everything else
+        self.win.noutrefresh()
 
-    # self.up/down/left/right just move relative to self.lines, cursor
-    #   position and self.top are computed in self.refresh()
+    # self.up/down/left/right just move relative to the lines of text, cursor
+    #   position and self.top are computed in self.render()
     def up(self):
         if self.top > 0:
             self.top -= 1
         self.refresh()
 
     def down(self):
-        if self.top < len(self.lines)-self.rows:
+        if self.top < self.nrows-self.rows:
             self.top += 1
         self.refresh()
 
@@ -191,8 +151,8 @@ class Viewer:
         # move down if necessary to see the link
         l = self.links[self.link]
         bottom = l['row'] + ( (l['col']+len(l['ID'])-1) // self.cols )
-        while self.top + self.rows <= bottom:
-            self.top += 1
+        if self.top + self.rows <= bottom:
+            self.top = bottom - self.rows + 1
         # move up if necessary to see the link
         if self.top > self.links[self.link]['row']:
             self.top = self.links[self.link]['row']
@@ -210,8 +170,8 @@ class Viewer:
         # move down if necessary to see the link
         l = self.links[self.link]
         bottom = l['row'] + ( (l['col']+len(l['ID'])-1) // self.cols )
-        while self.top + self.rows <= bottom:
-            self.top += 1
+        if self.top + self.rows <= bottom:
+            self.top = bottom - self.rows + 1
         # move up if necessary to see the link
         if self.top > self.links[self.link]['row']:
             self.top = self.links[self.link]['row']
@@ -255,7 +215,7 @@ class Viewer:
         ID = link['ID'].lstrip('#')
         # save old filepath, set new filepath, reload
         self.previous.append(self.filepath)
-        self.filepath = config.kasten_dir+ID
+        self.filepath = utils.filepath(ID)
         self.link = -1
         self.top = 0
         self.load()
@@ -284,7 +244,7 @@ class Viewer:
 
     # load new zettel in this window
     def load_ID(self, ID):
-        self.filepath = config.kasten_dir+ID
+        self.filepath = utils.filepath(ID)
         self.link = -1
         self.top = 0
         self.load()
@@ -319,6 +279,9 @@ class Viewer:
         elif k == ord('o'):         flag, val = self.open_link()
         elif k == ord('r'):
             utils.sync()
+            utils.update_link_graph() # pick up new backlinks
+            # rerun any code, its output may have changed
+            utils.forget_parsed(self.filepath.split('/')[-1])
             self.load()
             self.refresh()
         elif k == Keys.CTRL_SHIFT_UP:    flag, val = 'expand', 'vertical'
@@ -0,0 +1,159 @@
+############################################################################
+#
+#   Watcher.py
+#       watch kasten directory for changes, with inotify where available
+#       and polling otherwise
+#
+############################################################################
+
+import os
+import struct
+import threading
+import time
+import ctypes
+import ctypes.util
+import config
+import utils
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[]
+event_header = struct.Struct('iIII')
+
+class Watcher:
+    def __init__(self, directory=None, interval=None):
+        # directory to watch, None (e.g. SQLite storage) means poll
+        self.directory = directory or utils.storage().directory
+        # seconds between scans when polling
+        self.interval = interval or config.watch_interval
+        # ID -> 'changed' or 'deleted', latest event wins
+        self.events = {}
+        # flag for lost events (inotify queue overflow), rescan everything
+        self.overflow = False
+        self.lock = threading.Lock()
+        # inotify watch descriptor -> directory, the kasten and its shards
+        self.wds = {}
+
+        try:
+            self.fd = self.inotify()
+            target = self.run_inotify
+        except OSError:
+            self.fd = None
+            target = self.run_polling
+        self.thread = threading.Thread(target=target, daemon=True)
+        self.thread.start()
+
+    # set up inotify watches on directory and its subdirectories (shards),
+    #   return file descriptor
+    def inotify(self):
+        if not self.directory:
+            raise OSError('no directory to watch')
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init'):
+            raise OSError('inotify not available')
+        self.libc = libc
+        fd = libc.inotify_init()
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        try:
+            self.add_watch(fd, self.directory)
+            for entry in os.scandir(self.directory):
+                if entry.is_dir() and not entry.name.startswith('.'):
+                    self.add_watch(fd, entry.path + '/')
+        except OSError:
+            os.close(fd)
+            raise
+        return fd
+
+    def add_watch(self, fd, directory):
+        mask = (IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+                | IN_DELETE | IN_MOVED_FROM)
+        wd = self.libc.inotify_add_watch(fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+        self.wds[wd] = directory
+
+    # a directory appeared or disappeared
+    def directory_event(self, wd, name, mask):
+        if self.wds.get(wd) != self.directory or name.startswith('.'):
+            return  # only shards directly in the kasten hold zettel
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            # new shard, watch it and pick up anything already in it
+            shard = self.directory + name + '/'
+            try:
+                self.add_watch(self.fd, shard)
+                names = os.listdir(shard)
+            except OSError:
+                return
+            for name in names:
+                self.record(name, 'changed')
+        elif mask & IN_MOVED_FROM:
+            # shard moved away with zettel in it, no events for those
+            with self.lock:
+                self.overflow = True
+
+    def record(self, name, kind):
+        # ignore hidden files, e.g. temp files on their way to a rename
+        if not name or name.startswith('.'):
+            return
+        with self.lock:
+            self.events[name] = kind
+
+    def run_inotify(self):
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except OSError:
+                return
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = event_header.unpack_from(buf, offset)
+                offset += event_header.size
+                name = buf[offset:offset+length].rstrip(b'\0')
+                name = os.fsdecode(name)
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    with self.lock:
+                        self.overflow = True
+                elif mask & IN_IGNORED:
+                    self.wds.pop(wd, None)  # watched directory is gone
+                elif mask & IN_ISDIR:
+                    self.directory_event(wd, name, mask)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.record(name, 'deleted')
+                else:
+                    self.record(name, 'changed')
+
+    def run_polling(self):
+        snapshot = utils.scan_kasten()
+        while True:
+            time.sleep(self.interval)
+            try:
+                current = utils.scan_kasten()
+            except OSError:
+                continue
+            for ID in snapshot.keys() - current.keys():
+                self.record(ID, 'deleted')
+            for ID, stat in current.items():
+                if snapshot.get(ID) != stat:
+                    self.record(ID, 'changed')
+            snapshot = current
+
+    # take events gathered so far
+    # returns list of changed IDs, list of deleted IDs, and a flag for
+    #   lost events (in which case the kasten should be rescanned)
+    def take(self):
+        with self.lock:
+            events, self.events = self.events, {}
+            overflow, self.overflow = self.overflow, False
+        changed = [ID for ID, kind in events.items() if kind == 'changed']
+        deleted = [ID for ID, kind in events.items() if kind == 'deleted']
+        return changed, deleted, overflow
@@ -8,14 +8,35 @@
 import curses
 import numpy as np
 import config
+import Placement
 from Editor import Editor
 
+# draw window to curses' virtual screen if it's marked dirty, or copy it over
+#   again if something under it was drawn (force)
+# the top window is always drawn when anything under it was, and copied
+#   otherwise, to put the cursor back in it
+# returns True if window was drawn or copied, so those above know to be
+def composite(window, force=False, top=False):
+    if window.dirty or (force and top):
+        window.render()
+        return True
+    if force:
+        window.win.touchwin()
+    if force or top:
+        window.win.noutrefresh()
+    return force
+
 # possible annoyance: everything breaks if self.wins is empty
 class WindowStack:
     def __init__(self, screen):
         self.screen = screen
         # windows are stored in a list, index 0 at 'bottom' of stack
         self.wins = []
+        # window for the box around the top window, reused while the top
+        #   window stays put
+        self.border = None
+        # flag for windows added, removed or moved around since last drawn
+        self.dirty = True
         # initialize density map of windows in screen
         rows, cols = screen.getmaxyx()
         self.dmap, self.window_density = self.initialize_densities( rows,cols )
@@ -49,13 +70,31 @@ class WindowStack:
             for window in self.wins:
                 window.debugger(state=True, log=log)
 
+    # mark stack to be drawn over with the next frame
     def refresh(self):
-        if not self.wins: # if no windows, do nothing
-            return
-        # refresh windows from bottom to top
-        for window in self.wins:
-            window.refresh()
+        self.dirty = True
+
+    # windows are drawn to curses' virtual screen from bottom to top, and
+    #   go to the terminal together on the next curses.doupdate(), which
+    #   only sends the cells that changed since the last one
+    # only windows marked dirty are drawn again, and those above them copied
+    #   over again, or everything if force or the stack itself is dirty
+    # returns True if anything was drawn, see composite()
+    def render(self, force=False):
+        force = force or self.dirty
+        self.dirty = False
+        if not self.wins: # if no windows, nothing to draw
+            return force
+        for window in self.wins[:-1]:
+            force = composite(window, force)
         # draw a box around top window
+        if force or self.wins[-1].dirty:
+            self.box().noutrefresh()
+            force = True
+        return composite(self.wins[-1], force, top=True)
+
+    # window with a box around the top window
+    def box(self):
         y, x = self.wins[-1].getbegyx()
         rows, cols = self.wins[-1].getmaxyx()
         # adjust coordinates out by 1 if possible
@@ -68,11 +107,15 @@ class WindowStack:
         if x > 0:
             x -= 1
             if x + cols + 1 <= curses.COLS: cols += 1
-        temp = curses.newwin( rows,cols, y,x )
-        temp.border()
-        temp.refresh()
-        self.wins[-1].refresh()
-        del temp
+        border = self.border
+        if (border is None or border.getbegyx() != (y, x)
+                or border.getmaxyx() != (rows, cols)):
+            border = self.border = curses.newwin( rows,cols, y,x )
+            border.border()
+        else:
+            # windows below may have been drawn over it since
+            border.touchwin()
+        return border
 
     def push(self, window):
         # add window to stack
@@ -128,19 +171,10 @@ class WindowStack:
         y, x = divmod(index, mass_cols) # also argmin flattens, so unflatten
         return y, x
 
+    # placement strategy set by config.window_placement, see Placement.py
     def recommend(self, rows, cols):
-        density = self.window_density[:rows, :cols]
-        scr_rows, scr_cols = self.dmap.shape
-        candidate = [0,0]
-        candidate_score = np.multiply(density, self.dmap[:rows,:cols]).sum()
-
-        for x in range(scr_cols - cols + 1):
-            for y in range(scr_rows - rows + 1):
-                score = np.multiply(density, self.dmap[y:y+rows,x:x+cols]).sum()
-                if score <= candidate_score:
-                    candidate_score = score
-                    candidate = [y,x]
-        return candidate
+        strategy = Placement.strategies[config.window_placement]
+        return strategy(self, rows, cols)
 
     def up(self):
         self.wins.append(self.wins.pop(0))
@@ -11,3 +11,41 @@ kasten_dir = path + "kasten/"
 logfile = path + ".logfile"
 stack_save = path + ".stack_save"
 kasten_sync = False
+search_index = path + ".search_index"
+link_graph = path + ".link_graph"
+# seconds between saving changes to search_index and link_graph
+index_save_interval = 2
+# bounds on the in-memory title cache
+meta_cache_size = 200000
+meta_title_length = 256
+# where to put new windows: "least_overlap" (covering as little as possible
+#   of the windows already open), "cascade" or "tile"
+window_placement = "least_overlap"
+# number of zettel kept parsed for viewing
+parse_cache_size = 64
+# limits on code in zettel (after #!): seconds it may run for, and
+#   megabytes of memory it may use
+code_timeout = 5
+code_memory_limit = 1024
+# seconds between checks for changes, if inotify isn't available
+watch_interval = 2
+# minimum seconds between syncs with kasten_sync
+sync_interval = 10
+# where zettel are kept: "directory" (kasten_dir, one file per zettel) or
+#   "sqlite" (kasten_db, a single database with indexes for search/links)
+kasten_backend = "directory"
+kasten_db = path + "kasten.db"
+# keep zettel in kasten_dir in subdirectories by month (YYMM/ from the ID),
+#   for very large kastens---run :migrate after changing
+kasten_sharded = False
+# characters of undo history each editor keeps
+undo_limit = 1000000
+# zettel at least this many bytes are edited a screenful at a time rather
+#   than read in all at once
+large_file_threshold = 4000000
+# where editors keep journals of unsaved edits, to get them back after a
+#   crash, and seconds between making sure journals are on disk
+journal_dir = path + ".journal/"
+journal_interval = 5
+# counter for handing out new IDs
+id_counter = path + ".id_counter"
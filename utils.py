@@ -5,55 +5,283 @@
 #
 ############################################################################
 
-import datetime
 import re
 import os
-import subprocess
-from config import kasten_dir, logfile, kasten_sync
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import config
+
+# options added to config_template.py over time, with their defaults (paths
+#   next to config.path, as in the template), so a config.py copied from an
+#   older template keeps working
+def config_defaults(path):
+    return {
+        'search_index': path + '.search_index',
+        'link_graph': path + '.link_graph',
+        'index_save_interval': 2,
+        'meta_cache_size': 200000,
+        'meta_title_length': 256,
+        'window_placement': 'least_overlap',
+        'parse_cache_size': 64,
+        'code_timeout': 5,
+        'code_memory_limit': 1024,
+        'watch_interval': 2,
+        'sync_interval': 10,
+        'kasten_backend': 'directory',
+        'kasten_db': path + 'kasten.db',
+        'kasten_sharded': False,
+        'undo_limit': 1000000,
+        'large_file_threshold': 4000000,
+        'journal_dir': path + '.journal/',
+        'journal_interval': 5,
+        'id_counter': path + '.id_counter',
+        }
+
+# fill in options missing from config.py, before anything reads them
+for name, value in config_defaults(config.path).items():
+    if not hasattr(config, name):
+        setattr(config, name, value)
 
 def debugger(s):
-    log = logfile
+    log = config.logfile
     with open(log, 'a') as f:
         print(s, file=f)
 
+# storage backend for the kasten, see Storage.py, created on first use
+_storage = None
+
+def storage():
+    global _storage
+    if _storage is None:
+        from Storage import DirectoryStorage, SQLiteStorage
+        if config.kasten_backend == 'sqlite':
+            _storage = SQLiteStorage()
+        else:
+            _storage = DirectoryStorage()
+    return _storage
+
+# path of zettel, as used by Viewer and Editor (and saved in .stack_save)
+def filepath(ID):
+    return storage().path(ID)
+
+# snapshot of kasten in one pass: dict of ID -> (mtime, size)
+def scan_kasten():
+    return storage().scan()
+
+# read full text of a zettel, same as open(...).read()
+def read_text(ID):
+    return storage().read(ID)
+
+# split text into lines without newlines, same as stripping readlines()
+def split_lines(text):
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+# write zettel and update indexes
+def write_zettel(ID, text):
+    storage().write(ID, text)
+    reindex(ID, text)
+
+# read many zettel at once, fanning out over a thread pool
+# returns dict of ID -> read(ID), in the same order as IDs, leaving out
+#   zettel where read raises one of the exceptions in skip
+def read_zettel(IDs, read=read_text, skip=(OSError, UnicodeDecodeError)):
+    def attempt(ID):
+        try:
+            return True, read(ID)
+        except skip:
+            return False, None
+    IDs = list(IDs)
+    if len(IDs) < 2:    # not worth starting threads
+        results = map(attempt, IDs)
+    else:
+        with ThreadPoolExecutor() as executor:
+            results = list(executor.map(attempt, IDs))
+    return {ID: result for ID, (ok, result) in zip(IDs, results) if ok}
+
+# in-memory cache of titles, sizes and mtimes, created on first use
+_meta_cache = None
+
+def meta_cache():
+    global _meta_cache
+    if _meta_cache is None:
+        from MetaCache import MetaCache
+        _meta_cache = MetaCache()
+    return _meta_cache
+
 # entry point: list of IDs and titles
 def list_IDs_titles():
-    IDs = os.listdir(path=kasten_dir)
-
+    cache = meta_cache()
+    snapshot = cache.validate()
     zett = []
-    for ID in IDs:
-        with open(kasten_dir+ID, 'r') as f:
-            title = f.readline()
-            zett += [{'ID': ID, 'TITLE': title}]
+    for ID in snapshot:
+        try:
+            zett += [{'ID': ID, 'TITLE': cache.title(ID)}]
+        except FileNotFoundError:
+            pass    # deleted since the scan
     return zett
 
 # get title from ID
 def get_title(ID):
-    with open(kasten_dir+ID, 'r') as f:
-        title = f.readline().rstrip('\n')
-    return title
+    return meta_cache().title(ID).rstrip('\n')
+
+# zettel parsed for viewing, ID -> ((mtime, size), lines before any code,
+#   code, lines shown in place of code, ParsedZettel), least recently used
+#   first
+_parsed = OrderedDict()
+
+# code in zettel, from the first line marked by shebang, if any, and lines
+#   before it
+def split_code(lines):
+    for i in range(len(lines)):
+        if lines[i].startswith('#!'):
+            return lines[:i], '\n'.join(lines[i:])
+    return lines, None
+
+# parsed zettel, reusing the last parse unless the zettel has changed since
+# any code is run to show its output, see CodeRunner
+def parse_zettel(ID):
+    from ParsedZettel import ParsedZettel
+    stat = storage().stat(ID)
+    entry = _parsed.pop(ID, None)
+    if entry is None or entry[0] != stat:
+        text_lines, code = split_code(split_lines(read_text(ID)))
+        entry = (stat, text_lines, code, None, None)
+    stat, text_lines, code, output, parsed = entry
+    if code is not None:
+        # cached unless code or the zettel it depends on have changed
+        lines = code_runner().run(code, ID)
+        if lines is not output:
+            output, parsed = lines, None
+    if parsed is None:
+        parsed = ParsedZettel(text_lines + (output or []))
+    _parsed[ID] = (stat, text_lines, code, output, parsed)
+    while len(_parsed) > config.parse_cache_size:
+        _parsed.popitem(last=False)
+    return parsed
+
+# drop parsed zettel, and rerun its code next time
+def forget_parsed(ID):
+    entry = _parsed.pop(ID, None)
+    if entry is not None and entry[2] is not None:
+        code_runner().forget(entry[2], ID)
+
+# worker process for code in zettel, started on first use
+_code_runner = None
+
+def code_runner():
+    global _code_runner
+    if _code_runner is None:
+        from CodeRunner import CodeRunner
+        _code_runner = CodeRunner()
+    return _code_runner
+
+# persistent graph of links between zettel, loaded (and updated) on first use
+_link_graph = None
+
+def link_graph():
+    global _link_graph
+    if _link_graph is None:
+        _link_graph = storage().link_graph()
+        noticed(*_link_graph.update())
+    return _link_graph
+
+# bring link graph up to date with any changes to the kasten
+def update_link_graph():
+    noticed(*link_graph().update())
+
+# pass on changes to the kasten an index update picked up, so code in
+#   zettel depending on them reruns (and only then)
+def noticed(changed, deleted):
+    global _kasten_version
+    if not (changed or deleted):
+        return
+    _kasten_version += 1
+    if _code_runner is not None:
+        for ID in changed:
+            _code_runner.note(ID)
+        for ID in deleted:
+            _code_runner.note(ID, deleted=True)
+
+# bumped whenever indexes (may) pick up changes to the kasten, so code in
+#   zettel that depends on the whole kasten knows to rerun
+_kasten_version = 0
+
+def kasten_version():
+    return _kasten_version
+
+# update indexes for a zettel we just wrote, without rescanning the kasten
+def reindex(ID, text):
+    global _kasten_version
+    from LinkGraph import find_links
+    _kasten_version += 1
+    stat = storage().stat(ID)
+    graph = link_graph()
+    graph.set_links(ID, find_links(text), stat)
+    if _search_index is not None:
+        _search_index.add(ID, text, *stat)
+    if _meta_cache is not None:
+        _meta_cache.forget(ID)  # reread title on next lookup
+    if _code_runner is not None:
+        _code_runner.note(ID)
+
+# drop a deleted zettel from indexes
+def unindex(ID):
+    global _kasten_version
+    _kasten_version += 1
+    link_graph().remove(ID)
+    if _search_index is not None:
+        _search_index.remove(ID)
+    if _meta_cache is not None:
+        _meta_cache.forget(ID)
+    if _code_runner is not None:
+        _code_runner.note(ID, deleted=True)
+
+# time.monotonic() indexes were last saved
+_indexes_saved = 0
+
+# commit changes to indexes, at most every config.index_save_interval
+#   seconds (called every frame), or right away with now=True
+# changes not saved when zk dies are picked up again by the update() when
+#   the index is next loaded, as the kasten has them
+def save_indexes(now=False):
+    global _indexes_saved
+    if not now and \
+            time.monotonic() - _indexes_saved < config.index_save_interval:
+        return
+    _indexes_saved = time.monotonic()
+    if _link_graph is not None:
+        _link_graph.save()
+    if _search_index is not None:
+        _search_index.save()
+
+# apply changes noticed by a Watcher, rereading only the zettel involved
+def apply_changes(changed, deleted):
+    # leave out zettel indexed as they are, i.e. those we saved ourselves
+    #   (the watcher sees those too)
+    changed = [ID for ID in changed if not indexed(ID)]
+    texts = read_zettel(changed)
+    for ID in deleted + [ID for ID in changed if ID not in texts]:
+        unindex(ID)
+    for ID, text in texts.items():
+        try:
+            reindex(ID, text)
+        except FileNotFoundError:
+            unindex(ID) # deleted again since
+
+# whether zettel is in the indexes as it is now
+def indexed(ID):
+    try:
+        return link_graph().stat(ID) == storage().stat(ID)
+    except OSError:
+        return False
 
 # list IDs of zettel that link to target ID
 def list_backlinks(target_ID):
-    IDs = os.listdir(kasten_dir)    # get list of IDs
-    target_link = re.compile(f'#{target_ID}') # regex for links to target ID
-    backlinks = []
-
-    # get list of links in zettel (to exclude from backlinks)
-    with open(kasten_dir+target_ID, 'r') as f:
-        link = re.compile(r'#\d+[a-z]+')    # regex to match links in notes
-        text = f.read()
-        frontlinks = [link_ID.lstrip('#') for link_ID in link.findall(text)]
-
-    for ID in IDs:
-        if ID in frontlinks:
-            continue # skip IDs that already exist as forward links
-        with open(kasten_dir+ID, 'r') as f:
-            text = f.read()
-        match = target_link.search(text)   # search for link in filetext
-        if match:
-            backlinks.append(ID)    # if we found one, add ID to list
-    return backlinks
+    return link_graph().backlinks(target_ID)
 
 # increment letters in IDs, a -> b -> ... -> z -> aa -> ab -> ...
 def increment_letters(letters):
@@ -79,101 +307,155 @@ def ID_sort(ID):
     #   date, then number of letters, then lexicographic order of letters
     return [YYMMDD, len(letters), letters]
 
+# allocator for new IDs, created on first use
+_allocator = None
+
+def allocator():
+    global _allocator
+    if _allocator is None:
+        from IDAllocator import IDAllocator
+        _allocator = IDAllocator()
+    return _allocator
+
 # create a new zettel and return ID
 def new_zettel():
-    # find ID: YYMMDD followed by letters a, b, ..., z, aa, ab, ...
-    YYMMDD = datetime.date.today().isoformat().replace('-','')[2:]
-    IDs = sorted(os.listdir(path=kasten_dir), key=ID_sort)
-    if len(IDs) > 0:
-        last = IDs[-1]
-    else:
-        last = ''
-    if last[:6] == YYMMDD:
-        # if it's the same YYMMDD as the last, increment letters
-        letters = increment_letters(last[6:])
-    else: # otherwise just start from the beginning
-        letters = 'a'
-    ID = YYMMDD + letters
+    return allocator().allocate()[0]
+
+# create n new zettel at once and return their IDs, in order
+def new_zettels(n):
+    return allocator().allocate(n)
 
-    # create empty file
-    with open(kasten_dir+ID, 'a') as f:
-        pass
+# move zettel into the layout set by config.kasten_sharded (flat or in
+#   YYMM/ shards), or with the sqlite backend copy them from kasten_dir
+#   into kasten_db, return number of zettel moved or copied
+def migrate_kasten():
+    return storage().migrate()
 
-    return ID
+# background sync with remote, started on first use
+_syncer = None
+
+def syncer():
+    global _syncer
+    if _syncer is None:
+        from Syncer import Syncer
+        _syncer = Syncer()
+    return _syncer
+
+# whether the kasten is synced with a remote, only the directory backend
+#   can be (rclone syncs kasten_dir, the sqlite backend keeps zettel in
+#   kasten_db)
+def sync_enabled():
+    return bool(config.kasten_sync) and config.kasten_backend != 'sqlite'
 
 # sync kasten with remote at config.kasten_sync
-def sync():
-    if kasten_sync:
-        completed = subprocess.run(f'rclone bisync --max-delete 0 {kasten_dir} {kasten_sync}', shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        completed.check_returncode()
+# by default in the background, many calls in a row make one sync
+# wait=True syncs anything outstanding before returning, raising
+#   CalledProcessError if it fails (e.g. before quitting)
+def sync(wait=False):
+    if sync_enabled():
+        if wait:
+            syncer().flush()
+        else:
+            syncer().request()
+
+# status of background sync: flag for sync in progress, and exception
+#   from a failed sync (only reported once)
+def sync_status():
+    if _syncer is None:
+        return False, None
+    return _syncer.running, _syncer.take_error()
+
+# SQLite database at filepath for an index kept next to the kasten (see
+#   SearchIndex, LinkGraph), changed in place rather than loaded and saved whole
+# made afresh from schema (SQL creating its tables) if it's new, from
+#   another version, or not a database at all (e.g. an old pickled index)
+def index_db(filepath, version, schema):
+    import sqlite3
+    connect = lambda: sqlite3.connect(filepath, check_same_thread=False,
+            isolation_level=None)
+    db = connect()
+    try:
+        (found,), = db.execute('PRAGMA user_version')
+    except sqlite3.DatabaseError:
+        found = None
+    if found not in (0, version):
+        db.close()
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(filepath + suffix)
+            except FileNotFoundError:
+                pass
+        db = connect()
+        found = 0
+    if found == 0:
+        db.executescript(schema)
+        db.execute(f'PRAGMA user_version = {version}')
+    # an index can always be rebuilt from the kasten, so it only has to be
+    #   consistent after a crash, not have the latest changes
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+# persistent full-text search index, loaded (and updated) on first use
+_search_index = None
+
+def search_index():
+    global _search_index
+    if _search_index is None:
+        _search_index = storage().search_index()
+        noticed(*_search_index.update())
+    return _search_index
+
+# bring search index up to date with any changes to the kasten
+def update_search_index():
+    noticed(*search_index().update())
+
+# start a search-as-you-type session, see SearchIndex.SearchSession
+def search_session():
+    from SearchIndex import SearchSession
+    return SearchSession(search_index())
 
 # search zettels for text, return list of ID & title dicts
-def search_IDs_titles(search_text):
-    IDs = os.listdir(path=kasten_dir)
-    zett = []
-    # if search starts with '/', only search titles
-    if search_text.startswith('/'):
-        search_text = search_text[1:]
-        for ID in IDs:
-            with open(kasten_dir+ID, 'r') as f:
-                # readline for title
-                text = f.readline()
-                # add to the list if we found the search text
-                if search_text.lower() in text.lower():
-                    f.seek(0) # go back to beginning of file
-                    title = f.readline()
-                    zett.append({'ID': ID, 'TITLE': title})
-    # if search starts with '#', only search IDs
-    elif search_text.startswith('#'):
-        search_text = search_text[1:]
-        for ID in IDs:
-            with open(kasten_dir+ID, 'r') as f:
-                # just ID
-                text = ID
-                # add to the list if we found the search text
-                if search_text.lower() in text.lower():
-                    f.seek(0) # go back to beginning of file
-                    title = f.readline()
-                    zett.append({'ID': ID, 'TITLE': title})
-    # by default search full text
+# optionally within a search session, to reuse results as the text changes
+def search_IDs_titles(search_text, session=None):
+    index = search_index()
+    if session:
+        IDs = session.search(search_text)
     else:
-        for ID in IDs:
-            with open(kasten_dir+ID, 'r') as f:
-                # read for full text
-                text = f.read()
-                # add to the list if we found the search text
-                if search_text.lower() in text.lower():
-                    f.seek(0) # go back to beginning of file
-                    title = f.readline()
-                    zett.append({'ID': ID, 'TITLE': title})
-    return zett
+        IDs = index.query(search_text)
+    return [{'ID': ID, 'TITLE': index.title(ID)} for ID in IDs]
 
 # generate graph using protograph
 def protograph(directed=False):
-    IDs = os.listdir(kasten_dir)
+    IDs = storage().IDs()
+    texts = read_zettel(IDs, skip=())
+    # node numbers, so we don't have to search IDs for each link
+    numbers = {ID: i for i, ID in enumerate(IDs)}
     link = re.compile(r'#\d+[a-z]+')    # regex to match links in notes
     node_list = []
     edge_list = []
+    edge_set = set()    # to check for duplicates quickly
     for i, ID in enumerate(IDs):
-        with open(kasten_dir+ID, 'r') as f:
-            text = f.read()     # grab text to search for links
-            f.seek(0)
-            title = f.readline()
+        text = texts[ID]    # grab text to search for links
+        newline = text.find('\n')
+        title = text if newline == -1 else text[:newline+1]
         # add node with ID and title to list in protograph format
         node_list.append(f'node {ID} --hovertext {title}')
         # for each link
         for link_ID in link.findall(text):
             # get node number of linked zettel
-            j = IDs.index(link_ID.lstrip('#'))  # (get rid of leading hash)
+            j = numbers[link_ID.lstrip('#')]  # (get rid of leading hash)
             # add edge to list in protograph format, both ways if undirected
             # recall pg indexes by 1, so +1 everywhere
             if not directed:
                 forward = f'edge {i+1} {j+1}'
                 backward = f'edge {j+1} {i+1}'
-                if forward not in edge_list: # check to avoid duplicates
+                if forward not in edge_set: # check to avoid duplicates
                     edge_list.append(forward)
-                if backward not in edge_list:
+                    edge_set.add(forward)
+                if backward not in edge_set:
                     edge_list.append(backward)
+                    edge_set.add(backward)
             else:
                 edge_list.append(f'edge {i+1} {j+1}')
     # set commands to define nodes, define edges, then render
@@ -188,35 +470,13 @@ def protograph(directed=False):
 
 # convert row numbers between Viewer and Editor
 # give it one of the two, it returns the other
-def convert_row(ID, cols, viewer_row=None, editor_row=None):
+def convert_row(layout, viewer_row=None, editor_row=None):
     assert viewer_row != None or editor_row != None, 'must provide row'
-    line_lengths = []
-    with open(kasten_dir+ID, 'r') as f:
-        for line in f:
-            line = line.rstrip('\n')
-            if not line:
-                # empty line still takes up one row
-                line_lengths.append(1)
-            else:
-                # ceiling division to find number of rows
-                line_lengths.append( -(len(line) // -cols) )
-        # in case file is empty
-        if not line_lengths:
-            return 0
+    # layout is an editor's LineLayout, which has the rows each line takes
+    #   up in a window, so no need to read the zettel again
     if viewer_row != None:
-        # convert from viewer to editor
-        editor_row = 0
-        viewer_row -= line_lengths[0]
-        while viewer_row >= 0:
-            editor_row += 1
-            viewer_row -= line_lengths[editor_row]
-        # done, now delete viewer_row so editor_row gets returned
-        viewer_row = 0
+        # convert from viewer to editor, line containing viewer_row
+        return layout.find(viewer_row)[0]
     else: # editor_row != None
-        # convert from editor to viewer
-        viewer_row = sum(line_lengths[:editor_row])
-        # done, now delete editor_row so viewer_row gets returned
-        editor_row = 0
-    # after converting the one to the other we set the one to zero, so
-    #   this will return the other
-    return viewer_row or editor_row
+        # convert from editor to viewer, first row of line editor_row
+        return layout.start(editor_row)
@@ -7,18 +7,27 @@
 #
 ############################################################################
 
+import os
 import curses
 import time
 import traceback
 import utils
 import config
 from Keys import Keys
-from WindowStack import WindowStack
+from WindowStack import WindowStack, composite
 from Index import Index
 from Editor import Editor
 from Viewer import Viewer
 from StatusBar import StatusBar
-from subprocess import CalledProcessError
+from Watcher import Watcher
+from Input import Input, bracketed_paste
+from Journal import leftover_journals, set_aside
+import Keys_template
+
+# fill in keys added to Keys_template.py since Keys.py was copied from it
+for name, value in vars(Keys_template.Keys).items():
+    if not name.startswith('_') and not hasattr(Keys, name):
+        setattr(Keys, name, value)
 
 def debugger(s='', log=None):
     if not log:
@@ -27,6 +36,30 @@ def debugger(s='', log=None):
         print(time.asctime(),file=f)
         print(s+'\n', file=f)
 
+# pick up changes from watcher, update indexes, index list and any viewers
+# returns True if there were any changes
+def watch(watcher, index, windows):
+    changed, deleted, overflow = watcher.take()
+    if overflow:
+        # lost track of events, catch up from scratch
+        utils.update_link_graph()
+        utils.update_search_index()
+        index.update_list()
+    elif changed or deleted:
+        utils.apply_changes(changed, deleted)
+        index.apply_changes(changed, deleted)
+    else:
+        return False
+    # reload viewers, in case of new text, titles or backlinks
+    for window in windows:
+        if isinstance(window, Viewer):
+            try:
+                window.load()
+                window.refresh()
+            except OSError:
+                pass    # zettel was deleted, leave it as it was
+    return True
+
 def main(screen):
     screen.refresh()
     # stack of windows/containers active on screen in order
@@ -34,14 +67,8 @@ def main(screen):
 
     # create status bar at bottom row, not in window stack
     status = StatusBar(curses.newwin( 1,curses.COLS, curses.LINES-1,0 ))
-    # sync with remote if configured
-    if config.kasten_sync:
-        status.set(f'syncing with {config.kasten_sync}')
-        try:
-            utils.sync()
-            status.set('sync complete')
-        except CalledProcessError as e:
-            status.error(e)
+    # sync with remote if configured, in the background
+    utils.sync()
 
     # create index window, not in window stack
     index = Index(curses.newwin(curses.LINES-1,curses.COLS))
@@ -55,8 +82,9 @@ def main(screen):
     preview = Viewer(
             curses.newwin( curses.LINES-1,curses.COLS//2,
                 0,curses.COLS-curses.COLS//2),
-            config.kasten_dir+index.active_ID())
+            utils.filepath(index.active_ID()))
     show_preview = False     # flag to show preview pane
+    preview_ID = None   # ID loaded in preview pane, if shown
 
     # standard size for subwindows: at most half, at most 40x80
     std_rows = min(40, curses.LINES-1)
@@ -75,30 +103,118 @@ def main(screen):
     except:
         status.set(f'Could not load {config.stack_save}')
 
+    # reopen editors that never closed last time (zk crashed or was killed),
+    #   with their unsaved edits made again from their journals
+    recovered, lost = [], []
+    for ID, path in leftover_journals():
+        try:
+            y, x = stack.recommend(std_rows, std_cols)
+            editor = Editor(curses.newwin( std_rows,std_cols, y,x ),
+                    utils.filepath(ID))
+            if not editor.recover(path):
+                raise ValueError(f'{ID} changed since')
+            os.remove(path) # edits are in the new editor's journal now
+            stack.push(editor)
+            recovered.append(ID)
+        except (OSError, ValueError) as e:
+            debugger(f'could not recover {path}: {e}')
+            set_aside(path)
+            lost.append(ID)
+    if lost:
+        status.set(f'Could not recover unsaved edits to {", ".join(lost)}')
+    elif recovered:
+        status.set(f'Recovered unsaved edits to {", ".join(recovered)}')
+
     # for error handling
     error_loop = False
 
+    # watch kasten for changes made behind our back (syncs, other editors)
+    watcher = Watcher()
+    # keys from the terminal, with pasted text marked so editors can take
+    #   it in one go
+    keys = Input(screen)
+    bracketed_paste()
+    # flag for keys coming in faster than we draw, take them all before
+    #   drawing the next frame
+    batch = False
+    # which layers were shown in the last frame, to draw them all again if
+    #   they change
+    layers = None
+
     while True:
         try:    # general error handling
-            # refresh screen
-            if show_index or not stack:
-                stack.refresh()
-                index.refresh()
-                if show_preview:
-                    preview.load_ID(index.active_ID())
+            if not batch:
+                # show progress and errors of background sync
+                syncing, sync_error = utils.sync_status()
+                if sync_error:
+                    status.error(sync_error)
+                # wake up every so often to check for changes to the kasten,
+                #   more often while searching in the background
+                if index.search_pending():
+                    keys.timeout(50)
+                else:
+                    keys.timeout(250)
+                    status.set_busy('syncing ...' if syncing else '')
+                # draw a frame, only windows marked dirty since the last one
+                #   (after the status bar, so the cursor ends up in the top
+                #   window)
+                force = layers != (show_index or not stack, show_preview)
+                layers = (show_index or not stack, show_preview)
+                if show_index or not stack:
+                    if not show_preview:
+                        preview_ID = None
+                    elif index.active_ID() != preview_ID:
+                        preview_ID = index.active_ID()
+                        preview.load_ID(preview_ID)
+                    force = stack.render(force)
+                    force = composite(index, force, top=not show_preview)
+                    if show_preview:
+                        composite(preview, force, top=True)
+                else:
+                    force = composite(index, force)
+                    stack.render(force)
+                # get edits since the last frame into editors' journals
+                for window in stack.wins:
+                    if isinstance(window, Editor):
+                        window.journal.flush()
+                # and changes to indexes onto disk, every so often
+                utils.save_indexes()
+                # windows only draw to curses' virtual screen, send it all to
+                #   the terminal at once, only the cells that changed
+                curses.doupdate()
+            # text typed ahead or pasted into an editor comes in one piece
+            editor = stack.wins[-1] if stack and not show_index else None
+            if isinstance(editor, Editor) and not editor.searching:
+                k = keys.getch(text=True)
             else:
-                index.refresh()
-                stack.refresh()
-            k = screen.getch()
+                k = keys.getch()
             # if we've made it here, we're not in an infinite loop
             error_loop = False
 
+            # no key, just timed out to pick up search results and changes
+            if k == -1:
+                if batch:   # or caught up with keys, go draw
+                    batch = False
+                    continue
+                index.poll_search()
+                viewers = stack.wins + ([preview] if show_preview else [])
+                watch(watcher, index, viewers)
+                continue
+            # check for more keys before drawing
+            batch = True
+            keys.timeout(0)
+
+            if isinstance(k, str):
+                editor.insert_text(k)
+                continue
+
             # if resize, then resize
             if k == Keys.RESIZE:
                 y, x = screen.getmaxyx()
                 stack.resize( y,x )
                 index.resize( y,x )
                 status.resize( y,x )
+                layers = None   # draw everything
                 continue
 
             # pass keypress to active window
@@ -116,7 +232,7 @@ def main(screen):
                 y, x = stack.recommend(std_rows, std_cols)
                 stack.push(Editor(
                     curses.newwin( std_rows,std_cols, y,x ),
-                    config.kasten_dir+ID))
+                    utils.filepath(ID)))
                 show_index = False
             elif flag == 'edit':
                 ID = val # expect val to be ID of zettel to edit
@@ -124,7 +240,7 @@ def main(screen):
                 y, x = stack.recommend(std_rows, std_cols)
                 stack.push(Editor(
                     curses.newwin( std_rows,std_cols, y,x ),
-                    config.kasten_dir+ID))
+                    utils.filepath(ID)))
                 show_index = False
             elif flag == 'open':
                 ID = val # expect val to be ID of zettel to edit
@@ -132,20 +248,19 @@ def main(screen):
                 y, x = stack.recommend(std_rows, std_cols)
                 stack.push(Viewer(
                     curses.newwin( std_rows,std_cols, y,x ),
-                    config.kasten_dir+ID))
+                    utils.filepath(ID)))
                 show_index = False
             elif flag == 'edit->open': # change editor to viewer
                 ID, row = val # expect val to be list of ID and top row
-                window = stack.pop().win
-                rows, cols = window.getmaxyx()
-                row = utils.convert_row(ID, cols, editor_row=row)
-                stack.push(Viewer(window, config.kasten_dir+ID, row))
+                editor = stack.pop()
+                row = utils.convert_row(editor.layout, editor_row=row)
+                stack.push(Viewer(editor.win, utils.filepath(ID), row))
             elif flag == 'open->edit': # change viewer to editor
                 ID, row = val # expect val to be list of ID and top row
                 window = stack.pop().win
-                rows, cols = window.getmaxyx()
-                row = utils.convert_row(ID, cols, viewer_row=row)
-                stack.push(Editor(window, config.kasten_dir+ID, row))
+                # editor works out its top line from the viewer's top row
+                stack.push(Editor(window, utils.filepath(ID),
+                    viewer_row=row))
             elif flag == 'show_index':
                 show_index = True
             elif flag == 'hide_index':
@@ -165,8 +280,8 @@ def main(screen):
                     status.preview_ID(index.active_ID())
                 else:
                     index.search(status.search_text)
-                if not show_index:
-                    stack.refresh()
+                    if index.search_pending():
+                        status.set_busy('searching ...')
             elif flag == 'start_preview':       show_preview = True
             elif flag == 'end_preview':         show_preview = False
             elif flag == 'insert_link':
@@ -185,6 +300,14 @@ def main(screen):
                     index.sort()
                 elif instruction == 'sync':
                     utils.sync()
+                elif instruction == 'migrate':
+                    migrated = utils.migrate_kasten()
+                    # moves keep mtimes, and copies into the database are
+                    #   indexed as they're written, so this is just a rescan
+                    utils.update_link_graph()
+                    utils.update_search_index()
+                    index.update_list()
+                    status.set(f'migrated {migrated} zettel')
                 else:
                     status.set(f'command "{instruction}" not recognized')
             elif flag == 'status':
@@ -194,7 +317,11 @@ def main(screen):
             elif flag == 'quit':
                 # attempt to save and quit, failing if there is an editor
                 if stack.quit_ok():
-                    utils.sync()
+                    if utils.sync_enabled():
+                        status.set('syncing before quit ...')
+                        curses.doupdate()
+                    utils.sync(wait=True)
+                    utils.save_indexes(now=True)
                     filepaths = stack.list_filepaths()
                     with open(config.stack_save, 'w') as f:
                         f.write('\n'.join(filepaths))
@@ -217,6 +344,8 @@ def main(screen):
             elif flag == 'shrink':
                 stack.shrink(val) # expect val = 'vertical', 'horizontal'
         except Exception as e:
+            batch = False
+            layers = None   # draw everything, in case we stopped halfway
             status.error(e)
             debugger(f'error: {e}', log=config.logfile)
             status.debugger(state=True, log=config.logfile)
@@ -233,10 +362,16 @@ def main(screen):
         except KeyboardInterrupt:
             debugger(f'KeyboardInterrupt')
             status.error('KeyboardInterrupt: press any key to cancel, or KeyboardInterrupt again to quit WITHOUT SAVING')
+            curses.doupdate()
+            batch = False
+            layers = None
             screen.getch() # not sure why two are needed, but doesn't
             screen.getch() # seem to work with just one?
 
 if __name__ == '__main__':
     debugger('v'*15+'  START SESSION  '+'v'*15)
-    curses.wrapper(main)
+    try:
+        curses.wrapper(main)
+    finally:
+        bracketed_paste(False)
     debugger('^'*16+'  END SESSION  '+'^'*16)